@@ -1,29 +1,64 @@
+import os
 import h5py
 import numpy as np
 import pandas as pd
 import pyroomacoustics as pra
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from dechorate import constants
-from dechorate.utils.acu_utils import rt60_with_sabine, rt60_from_rirs
-from dechorate.utils.dsp_utils import resample
-from dechorate.utils.file_utils import load_from_pickle
-from dechorate.utils.geo_utils import compute_planes, compute_image, get_point
+from dechorate.utils.cache_utils import ArrayCache, load_or_compute
+from dechorate.utils.acu_utils import rt60_with_sabine, rt60_from_rirs, rt60_from_rirs_batch
+from dechorate.utils.dsp_utils import resample_poly
+from dechorate.utils.file_utils import load_from_pickle, MemmapSidecar
+from dechorate.utils.geo_utils import compute_planes, dist_points_plane
+from dechorate.utils.ism_utils import first_order_echoes, image_source_model, get_absorption_from_room_code
+from dechorate.utils.ism_utils import image_source_lattice, get_images, get_dampings, get_wall_sequences, synthesize_rirs
+
+# image sources shared by all the SyntheticDataset instances of the process
+images_cache = ArrayCache(max_bytes=2**28)
 
-class DechorateDataset():
 
-    def __init__(self, path_to_data, path_to_note, path_to_mic_src_note, path_to_echo_note):
+def open_data(path, swmr=False):
+    # hdf5 file or uncompressed memory-mapped sidecar (see main_build_memmap_sidecar.py)
+    if path.split('.')[-1] == 'json':
+        return MemmapSidecar(path)
+    return h5py.File(path, 'r', swmr=swmr)
+
+
+class DechorateDataset():
 
-        # open the dataset files
-        if not path_to_data.split('.')[-1] == 'hdf5':
-            raise ValueError('path_to_data must be the hdf5 file')
+    def __init__(self, path_to_data, path_to_note, path_to_mic_src_note, path_to_echo_note, path_to_recordings=None, cache=None, path_to_resampled=None, swmr=False):
 
+        # the dataset files are opened lazily, once per process (see _open)
+        if not path_to_data.split('.')[-1] in ['h5', 'hdf5', 'json']:
+            raise ValueError('path_to_data must be the hdf5 file or its json sidecar index')
         self.path_to_data = path_to_data
-        self.dset_data = h5py.File(self.path_to_data, 'r')
+        self.swmr = swmr
+        self._files = {}
+        self._pid = os.getpid()
+
+        # optional sound datasets, e.g. {'speech': 'dEchorate_speech.h5'}
+        self.path_to_recordings = {} if path_to_recordings is None else dict(path_to_recordings)
+        for signal, path in self.path_to_recordings.items():
+            if not signal in constants['signals']:
+                raise ValueError('Signals must be either %s' % constants['signals'])
+
+        # opt-in cache of decoded arrays, pass the same ArrayCache to share it
+        if not (cache is None or isinstance(cache, ArrayCache)):
+            raise ValueError('cache must be an ArrayCache')
+        self.cache = cache
+
+        # optional folder where resampled RIRs are persisted as <Fs_new>/<room>_<src>.npy
+        self.path_to_resampled = path_to_resampled
 
         if not path_to_note.split('.')[-1] == 'csv':
             raise ValueError('path_to_note must be the csv file')
         self.path_to_note = path_to_note
         self.dset_note = pd.read_csv(self.path_to_note)
+        # index the database once: (room_code, src_id, mic_id, src_signal, fornitures) -> row positions
+        self.dset_note_index = self._build_note_index(self.dset_note)
 
 
         if not path_to_mic_src_note.split('.')[-1] == 'pkl':
@@ -51,6 +86,37 @@ class DechorateDataset():
         self.synth_dset.set_room_size(self.room_size)
         self.synth_dset.set_c(self.c)
 
+        # first order echo model per room code, see get_synth_echoes
+        self._synth_echoes = {}
+        # higher order echoes per (room_code, mic, src, order), see get_echo_note
+        self._echo_notes = {}
+
+    def __getstate__(self):
+        # file handles are never shared between processes
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_pid'] = None
+        return state
+
+    def _open(self, path):
+        if self._pid != os.getpid():
+            # new (forked or spawned) process: do not touch the parent's handles
+            self._files = {}
+            self._pid = os.getpid()
+        if not path in self._files:
+            self._files[path] = open_data(path, swmr=self.swmr)
+        return self._files[path]
+
+    @property
+    def dset_data(self):
+        return self._open(self.path_to_data)
+
+    def close(self):
+        if self._pid == os.getpid():
+            for f in self._files.values():
+                f.close()
+        self._files = {}
+
     def set_entry(self, room_code, mic, src):
         self.i = mic
         self.j = src
@@ -58,79 +124,285 @@ class DechorateDataset():
         self.src_pos = self.mic_src_echo_note['srcs'][:, self.j]
         self.room_code = room_code
 
+    @staticmethod
+    def _build_note_index(dset_note):
+        keys = pd.DataFrame({
+            'room_code': dset_note['room_code'].map(lambda x: '%06d' % int(x)),
+            'src_id': dset_note['src_id'].fillna(-1).astype(int),
+            'mic_id': dset_note['mic_id'].fillna(-1).astype(int),
+            'src_signal': dset_note['src_signal'],
+            'room_fornitures': dset_note['room_fornitures'].astype(bool),
+        })
+        return keys.groupby(list(keys.columns), sort=False).indices
+
+    @staticmethod
+    def _note_key(room_code, mic, src, src_signal):
+        # ids in the database are 1-based, room 020002 is the one with fornitures
+        fornitures = int(room_code[1]) > 1
+        return (room_code, int(src)+1, int(mic)+1, src_signal, fornitures)
+
     def get_entry(self, src_signal):
-        f, c, w, s, e, n = [int(i) for i in self.room_code]
-        entry = self.dset_note.loc[
-              (self.dset_note['room_rfl_floor'] == f)
-            & (self.dset_note['room_rfl_ceiling'] == c)
-            & (self.dset_note['room_rfl_west'] == w)
-            & (self.dset_note['room_rfl_east'] == e)
-            & (self.dset_note['room_rfl_north'] == n)
-            & (self.dset_note['room_rfl_south'] == s)
-            & (self.dset_note['src_id'] == self.j+1)
-            & (self.dset_note['mic_id'] == self.i+1)
-            & (self.dset_note['src_signal'] == src_signal)
-        ]
-        assert len(entry) > 0
-        return entry
+        key = self._note_key(self.room_code, self.i, self.j, src_signal)
+        assert key in self.dset_note_index
+        return self.dset_note.iloc[self.dset_note_index[key]]
+
+    def get_entries(self, room_codes, mics, srcs, src_signal):
+        keys = [self._note_key(room_code, i, j, src_signal)
+                for room_code in room_codes for j in srcs for i in mics]
+        missing = [key for key in keys if not key in self.dset_note_index]
+        if len(missing) > 0:
+            raise ValueError('Entries not in the database: %s' % missing)
+        rows = np.concatenate([self.dset_note_index[key] for key in keys])
+        return self.dset_note.iloc[rows]
+
+    @staticmethod
+    def _get_rir_group(room_code, src):
+        # as written by main_estimate_rirs.py: n_samples x n_mics, recording offset already compensated
+        return '/rir/%s/%d' % (room_code, src)
+
+    def _read(self, dset, path, group, sel=np.s_[...]):
+        # memory-mapped sidecars are served zero-copy, no need to cache them
+        if self.cache is None or isinstance(dset, MemmapSidecar):
+            return dset[group][sel]
+        key = (path, group)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.cache.put(key, dset[group][()])
+        return np.array(data[sel])
+
+    def _get_resampled_rirs(self, room_code, src, Fs_new):
+        # all the mics of a room/source are resampled in one call
+        group = self._get_rir_group(room_code, src)
+        key = (self.path_to_data, group, Fs_new)
+        if self.cache is not None:
+            rirs = self.cache.get(key)
+            if rirs is not None:
+                return rirs
+
+        # the folder is shared by the DataLoader workers
+        path_to_cache = None
+        if self.path_to_resampled is not None:
+            path_to_cache = os.path.join(self.path_to_resampled, str(Fs_new))
+        rirs = load_or_compute(path_to_cache, '%s_%d' % (room_code, src),
+                               lambda: resample_poly(self.dset_data[group][()], self.Fs, Fs_new, axis=0), saver='npy')
+
+        if self.cache is not None:
+            self.cache.put(key, rirs)
+        return rirs
 
     def get_rir(self, Fs_new =None):
-        group = '%s/%s/%d/%d' % (self.room_code, 'rir', self.j+1, self.i+1)
-        rir = self.dset_data[group]
-        rir = rir[constants['recording_offset']:]
         if not Fs_new  is None and Fs_new  != self.Fs:
-            print('Resampling with Librosa %d --> %d' % (self.Fs, Fs_new))
-            rir = resample(rir, self.Fs, Fs_new)
+            rir = np.array(self._get_resampled_rirs(self.room_code, self.j, Fs_new)[:, self.i])
+        else:
+            group = self._get_rir_group(self.room_code, self.j)
+            rir = self._read(self.dset_data, self.path_to_data, group, np.s_[:, self.i])
         self.rir = rir.squeeze()
         return rir
 
+    def get_rirs(self, rooms, mics, srcs, length=None, Fs_new=None):
+        mics = np.asarray(mics, dtype=int)
+        resampling = not Fs_new is None and Fs_new != self.Fs
+        # one hyperslab per room/source dataset spanning the requested mics
+        lo, hi = np.min(mics), np.max(mics) + 1
+        if length is None:
+            if resampling:
+                length = self._get_resampled_rirs(rooms[0], srcs[0], Fs_new).shape[0]
+            else:
+                length = self.dset_data[self._get_rir_group(rooms[0], srcs[0])].shape[0]
+
+        rirs = np.zeros([length, len(mics), len(srcs), len(rooms)])
+        buffer = np.zeros([length, hi - lo])
+        for d, room_code in enumerate(rooms):
+            for j, src in enumerate(srcs):
+                group = self._get_rir_group(room_code, src)
+                if resampling or isinstance(self.dset_data, MemmapSidecar):
+                    if resampling:
+                        data = self._get_resampled_rirs(room_code, src, Fs_new)
+                    else:
+                        data = self.dset_data[group]
+                    L = min(length, data.shape[0])
+                    rirs[:L, :, j, d] = data[:L, mics]
+                    continue
+                if self.cache is None:
+                    data = self.dset_data[group]
+                    L = min(length, data.shape[0])
+                    data.read_direct(buffer, source_sel=np.s_[:L, lo:hi], dest_sel=np.s_[:L, :])
+                else:
+                    data = self._read(self.dset_data, self.path_to_data, group, np.s_[:length, lo:hi])
+                    L = data.shape[0]
+                    buffer[:L] = data
+                rirs[:L, :, j, d] = buffer[:L, mics - lo]
+        return rirs
+
+    def _get_signal_path_and_group(self, signal, room_code, src):
+        if signal == 'rir':
+            return self.path_to_data, self._get_rir_group(room_code, src)
+        if not signal in self.path_to_recordings:
+            raise ValueError('No dataset given for signal %s' % signal)
+        if signal == 'silence':
+            src = constants['silence_ids'][0]
+        return self.path_to_recordings[signal], '/%s/%s/%d' % (signal, room_code, src)
+
+    @staticmethod
+    def _get_signal_src_ids(signal, srcs=None):
+        # one silence recording per room, babble is played by the noise sources
+        if signal == 'silence':
+            return list(constants['silence_ids'])
+        ids = constants['nse_ids'] if signal == 'babble' else constants['src_ids']
+        if srcs is None:
+            return list(ids)
+        return [src for src in srcs if src in ids]
+
+    def get_recording(self, signal):
+        path, group = self._get_signal_path_and_group(signal, self.room_code, self.j)
+        return self._read(self._open(path), path, group, np.s_[:, self.i])
+
+    def _get_entry_echoes(self, room_code, mics, src):
+        # picked echo timings, amplitudes from the first order model
+        toas = np.full([7, len(mics)], np.nan)
+        amps = np.full([7, len(mics)], np.nan)
+        note = self.mic_src_echo_note['toa_pck']
+        if src < note.shape[-1]:
+            toas = note[:7, mics, src]
+            amps = self.get_synth_echoes(room_code)[1][:, mics, src]
+        return toas, amps
+
+    def iter_entries(self, rooms=None, signals=None, mics=None, srcs=None, batch_size=1, n_workers=2, queue_depth=4):
+        '''
+        Yield batches of (data, mic_pos, src_pos, toas, amps, info) over the
+        rooms x signals x srcs groups, with shapes
+            data: B x n_samples x I (x n_utts), mic_pos: B x 3 x I, src_pos: B x 3,
+            toas, amps: B x 7 x I, info: list of (signal, room_code, src).
+        The amps are the ones of get_synth_echoes, damping / (4 pi distance).
+        A pool of threads reads and decompresses the next groups in the
+        background, with at most queue_depth groups in flight.
+        Batches never mix signals.
+        The srcs of each signal are the ones it was recorded with: silence
+        has one group per room (src 99) and babble is restricted to the
+        noise sources.
+        '''
+        rooms = constants['datasets'] if rooms is None else rooms
+        signals = ['rir'] if signals is None else signals
+        mics = np.arange(30) if mics is None else np.asarray(mics, dtype=int)
+        lo, hi = np.min(mics), np.max(mics) + 1
+
+        units = [(signal, room_code, src) for signal in signals for room_code in rooms
+                 for src in self._get_signal_src_ids(signal, srcs)]
+        # open the files from this thread only
+        for signal in signals:
+            self._open(self._get_signal_path_and_group(signal, rooms[0], 0)[0])
+
+        def load(unit):
+            path, group = self._get_signal_path_and_group(*unit)
+            data = self._read(self._open(path), path, group, np.s_[:, lo:hi])
+            return data[:, mics - lo]
+
+        def make_batch(batch):
+            data = np.stack([b[0] for b in batch])
+            mic_pos = np.stack([self.mic_src_echo_note['mics'][:, mics] for b in batch])
+            src_pos = np.full([len(batch), 3], np.nan)
+            toas = np.full([len(batch), 7, len(mics)], np.nan)
+            amps = np.full([len(batch), 7, len(mics)], np.nan)
+            for b, (_, (signal, room_code, src)) in enumerate(batch):
+                # babble and silence are not emitted by the calibrated sources
+                if signal in ['babble', 'silence']:
+                    continue
+                src_pos[b] = self.mic_src_echo_note['srcs'][:, src]
+                toas[b], amps[b] = self._get_entry_echoes(room_code, mics, src)
+            return data, mic_pos, src_pos, toas, amps, [b[1] for b in batch]
+
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            pending = deque()
+            for unit in units[:queue_depth]:
+                pending.append((unit, pool.submit(load, unit)))
+            next_unit = len(pending)
+
+            batch = []
+            while len(pending) > 0:
+                unit, future = pending.popleft()
+                data = future.result()
+                if next_unit < len(units):
+                    pending.append((units[next_unit], pool.submit(load, units[next_unit])))
+                    next_unit += 1
+
+                if len(batch) > 0 and batch[-1][1][0] != unit[0]:
+                    yield make_batch(batch)
+                    batch = []
+                batch.append((data, unit))
+                if len(batch) == batch_size:
+                    yield make_batch(batch)
+                    batch = []
+            if len(batch) > 0:
+                yield make_batch(batch)
+
     def get_mic_and_src_pos(self, updated=True):
         self.mic_pos = self.mic_src_echo_note['mics'][:, self.i]
         self.src_pos = self.mic_src_echo_note['srcs'][:, self.j]
         return self.mic_pos, self.src_pos
 
     def get_echo(self, kind='pck', order=0):
+        '''
+        Echo timings of the entry: 'pck' the picked ones, 'sym' the first
+        order model. order=0 and order=1 return the same direct path and
+        first order echoes; order > 1 returns all the echoes of get_echo_note
+        (sym only, the picked annotations stop at order 1).
+        '''
         if not kind in ['sym', 'pck']:
             raise ValueError('Kind must be either sym or pck')
         if kind == 'sym':
             # toas = self.mic_src_echo_note['toa_sym'][:, self.i, self.j]
-            toas, amps, walls = self.get_synth_note(tk_order='earliest')
-            # # sort the toas according to the walls
-            # indices = np.zeros_like(toas)
-            # for i in range(len(indices)):
-            #     indices[i] = constants['refl_order_calibr'].index(walls[i])
-            # indices = np.argsort(indices)
-            # toas = toas[indices]
-            # walls = walls[indices]
+            toas, amps, walls = self.get_synth_echoes()
+            toas = np.sort(toas[:, self.i, self.j])
         if kind == 'pck':
             toas = self.mic_src_echo_note['toa_pck'][:, self.i, self.j]
-        if order > 0:
-            raise NotImplementedError
+        if order > 1:
+            if kind == 'pck':
+                raise ValueError('pck annotations only exist up to order 1')
+            toas, _, _ = self.get_echo_note(order)
         return toas
 
+    def get_echo_note(self, order, absb=0.9, refl=0.1):
+        '''
+        Echoes up to the given reflection order sorted by toa, with their
+        generator wall sequences. The amps are damping / (4 pi distance).
+        '''
+        key = (self.room_code, self.i, self.j, order, absb, refl)
+        if not key in self._echo_notes:
+            absorption = get_absorption_from_room_code(self.room_code, absb=absb, refl=refl)
+            toas, amps, walls, _ = image_source_model(
+                self.room_size, self.mic_pos, self.src_pos, self.c, order, absorption)
+            toas, amps, walls = toas[:, 0, 0], amps[:, 0, 0], walls[:, 0, 0]
+            idx = np.argsort(toas)
+            self._echo_notes[key] = (toas[idx], amps[idx], walls[idx])
+        return self._echo_notes[key]
+
+    def get_synth_echoes(self, room_code=None, absb=0.9, refl=0.1):
+        '''
+        Direct path and first order echoes for all the mics and sources: 7 x I x J.
+        The amps are damping / (4 pi distance).
+        '''
+        room_code = self.room_code if room_code is None else room_code
+        key = (room_code, absb, refl)
+        if not key in self._synth_echoes:
+            absorption = get_absorption_from_room_code(room_code, absb=absb, refl=refl)
+            self._synth_echoes[key] = first_order_echoes(
+                self.room_size, self.mic_src_echo_note['mics'], self.mic_src_echo_note['srcs'],
+                self.c, absorption, walls=constants['refl_order_calibr'])
+        return self._synth_echoes[key]
 
     def get_synth_echo(self, walls):
-        m = self.mic_pos.copy()
-        s = self.src_pos.copy()
-
-
-        # W = len(walls)
-        # toas = np.zeros(W)
-        # for w, wall in enumerate(walls):
-        #     if not wall in constants['refl_order_calibr']:
-        #         raise ValueError('Wall must be either  "c", "f", "w", "s", "e", or "n"')
-
-        #     if wall == 'd':
-        #         im = get_point(m)
-        #     else:
-        #         plane = compute_planes(constants['room_size'])[wall]
-        #         im = compute_image(m, plane)
-
-        #     toas[w] = float(im.distance(s).evalf())/constants['speed_of_sound']
-
-        return toas
+        for wall in walls:
+            if not wall in constants['refl_order_calibr']:
+                raise ValueError('Wall must be either "d", "c", "f", "w", "s", "e", or "n"')
+        toas, _, _ = first_order_echoes(self.room_size, self.mic_pos, self.src_pos, self.c, walls=walls)
+        return toas[:, 0, 0]
 
     def get_synth_note(self, tk_order='earliest'):
+        '''
+        First order echoes of the entry from SyntheticDataset. The amps follow
+        its pyroomacoustics convention, damping / distance: they are 4 pi times
+        the ones of get_echo_note and get_synth_echoes.
+        '''
         sdset = SyntheticDataset()
         sdset.set_room_size(self.room_size)
         sdset.set_dataset(self.room_code, absb=0.9, refl=0.1)
@@ -147,9 +419,26 @@ class DechorateDataset():
             raise ValueError('RIR not retrieved yet. call get_rir\(\) explicitly')
         return rt60_from_rirs(self.rir, self.Fs, M=M, snr=snr, do_schroeder=do_schroeder, val_min=val_min)
 
+    def compute_rt60s(self, rooms=None, mics=None, srcs=None, M=100, snr=45, do_schroeder=True, val_min=-90, bands=None):
+        # RT60 and EDT of all the selected RIRs at once: I x J x D (or B x I x J x D with octave bands)
+        rooms = constants['datasets'] if rooms is None else rooms
+        mics = np.arange(30) if mics is None else mics
+        srcs = constants['src_ids'] if srcs is None else srcs
+        rirs = self.get_rirs(rooms, mics, srcs)
+        L, I, J, D = rirs.shape
+        rt60, edt = rt60_from_rirs_batch(rirs.reshape(L, -1), self.Fs, M=M, snr=snr,
+                                         do_schroeder=do_schroeder, val_min=val_min, bands=bands)
+        shape = rt60.shape[:-1] + (I, J, D)
+        return rt60.reshape(shape), edt.reshape(shape)
+
 
 class SyntheticDataset():
-    def __init__(self):
+    '''
+    Shoebox image source model of the dEchorate room.
+    The echo amplitudes (get_note, get_notes) and the RIRs (get_rir, get_rirs)
+    follow pyroomacoustics' convention damping / distance, with both backends.
+    '''
+    def __init__(self, cache=images_cache, path_to_cache=None):
         self.x = [2, 2, 2]
         self.s = [4, 3, 1]
         self.Fs = 48000
@@ -164,6 +453,18 @@ class SyntheticDataset():
 
         self.rir = None
 
+        # wall names in the order of pyroomacoustics' ShoeBox
+        self.wallsId = ['west', 'east', 'south', 'north', 'floor', 'ceiling']
+
+        # image sources: 'numpy' (vectorized lattice) or 'pra' (pyroomacoustics)
+        self.backend = 'numpy'
+
+        # image sources memo: in-memory LRU and optional .npz files keyed by a parameter hash
+        if not (cache is None or isinstance(cache, ArrayCache)):
+            raise ValueError('cache must be an ArrayCache')
+        self.cache = cache
+        self.path_to_cache = path_to_cache
+
         self.absorption = {
             'north': 0.8,
             'south': 0.8,
@@ -202,20 +503,19 @@ class SyntheticDataset():
         self.k_order = K
 
     def set_dataset(self, dset_code, absb=0.2, refl=0.8):
-        f, c, w, s, e, n = [int(i) for i in list(dset_code)]
-        self.absorption = {
-            'north': refl if n else absb,
-            'south': refl if s else absb,
-            'east': refl if e else absb,
-            'west': refl if w else absb,
-            'floor': refl if f else absb,
-            'ceiling': refl if c else absb,
-        }
+        self.absorption = get_absorption_from_room_code(dset_code, absb=absb, refl=refl)
+
+    def set_backend(self, backend):
+        if not backend in ['numpy', 'pra']:
+            raise ValueError('Backend must be numpy or pra')
+        self.backend = backend
 
     def make_room(self):
+        # pra dampings are sqrt(1 - energy absorption), the image reflections 1 - absorption
+        materials = {wall: pra.Material(1 - (1 - a)**2) for wall, a in self.absorption.items()}
         room = pra.ShoeBox(
             self.room_size, fs=self.Fs,
-            absorption=self.absorption, max_order=self.k_order)
+            materials=materials, max_order=self.k_order)
         room.set_sound_speed(self.c)
         room.add_microphone_array(
             pra.MicrophoneArray(
@@ -248,12 +548,33 @@ class SyntheticDataset():
 
         return
 
+    def get_rirs(self, mics, srcs=None, L=None):
+        '''
+        RIRs of the current room for all the mic/source pairs in one call.
+        mics: 3 x I, srcs: 3 x J (default: the current source)
+        Returns rirs: L x I x J, with amplitudes damping / distance as pra's compute_rir
+        '''
+        mics = np.asarray(mics, dtype=float).reshape(3, -1)
+        if srcs is None:
+            srcs = np.array(self.s)
+        srcs = np.asarray(srcs, dtype=float).reshape(3, -1)
+        toas, amps = [], []
+        for j in range(srcs.shape[1]):
+            images, dampings, _ = self._get_images(srcs[:, j])
+            distances = np.linalg.norm(images[:, :, None] - mics[:, None, :], axis=0)
+            toas.append(distances / self.c)
+            amps.append(dampings[:, None] / distances)
+        return synthesize_rirs(np.stack(toas, axis=-1), np.stack(amps, axis=-1), self.Fs, L=L)
+
     def get_rir(self, normalize : bool):
-        room = self.make_room()
-        room.image_source_model()
-        room.compute_rir()
-        rir = room.rir[0][0]
-        rir = rir[40:]
+        if self.backend == 'numpy':
+            rir = self.get_rirs(np.array(self.x))[:, 0, 0]
+        else:
+            room = self.make_room()
+            room.image_source_model()
+            room.compute_rir()
+            rir = room.rir[0][0]
+            rir = rir[40:]
         self.rir = rir
         if normalize:
             return np.arange(len(rir))/self.Fs, rir/np.max(np.abs(rir))
@@ -271,96 +592,123 @@ class SyntheticDataset():
         #         return wall_name
 
     def get_wall_order_from_images(self, images, order, room_size):
+        # first order images are mirrored by the wall through their midpoint with the source
+        order = np.asarray(order)
+        if np.any(order > 1):
+            raise ValueError('Only first order images have a single wall, use get_wall_sequences')
         planes = compute_planes(room_size)
-        img0 = images[:, np.where(order == 0)].squeeze()
-        D, K = images.shape
-        walls = []
-        for k in range(K):
-            bar = (img0 + images[:, k])/2
-            dist = np.linalg.norm(img0 - images[:, k])
-            if dist < 1e-16:
-                walls.append('d')
+        img0 = images[:, order == 0]
+        bar = (img0 + images)/2
+        walls = np.full(images.shape[1], 'd')
+        for p in planes:
+            P = planes[p]
+            if P is None:
                 continue
+            walls[(order == 1) & (dist_points_plane(bar, P) < 1e-9)] = p
+        assert np.all((walls == 'd') == (order == 0))
+        return list(walls)
+
+    def _get_images(self, src):
+        # the images depend only on (room_size, src, k_order, absorption), not on the mic
+        key = (
+            tuple(float(x) for x in self.room_size),
+            tuple(float(x) for x in src),
+            self.k_order,
+            tuple(sorted((wall, float(a)) for wall, a in self.absorption.items())),
+        )
+        if self.cache is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+
+        def compute():
+            lattice_n, lattice_p, orders = image_source_lattice(self.k_order)
+            return {
+                'images': get_images(self.room_size, src, lattice_n, lattice_p)[:, :, 0],
+                'dampings': get_dampings(lattice_n, lattice_p, self.absorption),
+                'orders': np.array(orders),
+            }
+        # shared by DataLoader workers and main_build_synthetic_rirs.py processes
+        value = load_or_compute(self.path_to_cache, key, compute)
+        value = (value['images'], value['dampings'], value['orders'])
+
+        if self.cache is not None:
+            self.cache.put(key, value)
+        return value
+
+    def get_images(self):
+        '''
+        Image sources of the current room and source up to k_order,
+        memoized per (room_size, source, k_order, absorption).
+        Returns images: 3 x K, dampings and orders: K
+        '''
+        return self._get_images(np.array(self.s, dtype=float))
+
+    def get_notes(self, mics, walls=True):
+        '''
+        Image source notes of the current room and source at many microphones at once.
+        mics: 3 x I
+        Returns tk, ak (damping / distance), wall sequences: K x I and the orders: K, in lattice order
+        '''
+        mics = np.asarray(mics, dtype=float).reshape(3, -1)
+        images, dampings, orders = self.get_images()
+        distances = np.linalg.norm(images[:, :, None] - mics[:, None, :], axis=0)
+        tk = distances / self.c
+        ak = dampings[:, None] / distances
+        wk = None
+        if walls:
+            wk = get_wall_sequences(self.room_size, images[:, :, None], mics, self.k_order)[:, :, 0]
+        return tk, ak, wk, orders
 
-            bar = get_point(bar)
-            for p in planes:
-                P = planes[p]
-
-                if P is None:
-                    continue
-                else:
-                    dist = float(P.distance(bar).evalf())
-                    if dist == 0:
-                        walls.append(p)
-        assert len(walls) == K
-        return walls
-
-    def get_note(self, ak_normalize: bool = False, tk_order : str = 'pra_order'):
-
-        room = self.make_room()
-        room.image_source_model()
-        self.wallsId = room.wall_names
-
-        assert room.mic_array.R.shape[1] == 1
-        assert len(room.sources) == 1
+    def get_note(self, ak_normalize: bool = False, tk_order : str = 'pra_order', walls: bool = True):
 
-        j = 0
         K = self.k_reflc
-        source = room.sources[j]
 
-        images = source.images
-        orders = source.orders
-        dampings = source.damping
+        if self.backend == 'numpy':
+            # 'pra_order' is the lattice order here, i.e. sorted by reflection order
+            tk, ak, wk, _ = self.get_notes(np.array(self.x), walls=walls)
+            tk, ak = tk[:, 0], ak[:, 0]
+            if walls:
+                wk = wk[:, 0]
+        else:
+            room = self.make_room()
+            room.image_source_model()
+            self.wallsId = room.wall_names
 
-        # walls = self.get_wall_order_from_images(images,orders,self.room_size)
-        walls = None
+            assert room.mic_array.R.shape[1] == 1
+            assert len(room.sources) == 1
 
-        distances = np.linalg.norm(
-            images - room.mic_array.R, axis=0)
+            j = 0
+            source = room.sources[j]
 
-        tk = distances / self.c
-        dk = dampings.squeeze()
-        ak = dk / (distances)
-        # wk = np.array(walls)
+            images = source.images
+            orders = source.orders
+            dampings = source.damping
+
+            distances = np.linalg.norm(
+                images - room.mic_array.R, axis=0)
 
-        # walls = []
-        # order = np.zeros(K)
-        # generators = []
+            tk = distances / self.c
+            dk = dampings.squeeze()
+            ak = dk / (distances)
+            wk = None
+            if walls:
+                wk = get_wall_sequences(self.room_size, images[:, :, None], room.mic_array.R, self.k_order)[:, 0, 0]
 
         # order for location
         if tk_order == 'earliest':
             indices = np.argsort(tk)
         elif tk_order == 'pra_order':
-            indices = np.arange(K)
+            indices = np.arange(len(tk))
         elif tk_order == 'strongest':
             indices = np.argsort(np.abs(ak))[::-1]
         else:
             raise ValueError('Wrong ordering option')
 
         tk = tk[indices[:K]]
-        dk = dk[indices[:K]]
         ak = ak[indices[:K]]
-        wk = None
-
-        # for o, k in enumerate(ordering):
-            # print(room.sources[j].damping)
-            # amp[o] = room.sources[j].damping[k] / (4 * np.pi * distances[k])
-            # toa[o] = distances[k]/self.c
-            # order[o] = room.sources[j].orders[k]
-
-            # wall_id = self.get_walls_name_from_id(room.sources[j].walls[k])
-            # wall_sequence = room.sources[j].wall_sequence(k)
-            # wall_sequence = [self.get_walls_name_from_id(wall) for wall in wall_sequence]
-            # wall_sequence = wall_sequence
-            # if len(wall_sequence) > 1:
-            #     wall_sequence = wall_sequence[:-1]
-            # wall_sequence = '_'.join(wall_sequence)
-            # generators.append(wall_sequence)
-            # walls.append(wall_id)
-
-            # assert wall_id == generators[o][0]
-            # assert 'direct' == generators[o][-1]
-
+        if walls:
+            wk = wk[indices[:K]]
 
         if ak_normalize:
             ak = ak/np.max(np.abs(ak))
@@ -0,0 +1,103 @@
+import os
+import time
+import h5py
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from tqdm import tqdm
+
+from dechorate import constants # these are stored in the __init__py file
+from dechorate.utils.file_utils import h5_storage_options, get_h5_datasets
+
+
+def synthetic_rirs(n_groups, n_samples, n_mics, seed=0):
+    # exponentially decaying noise, as a stand-in for dEchorate_rir.h5
+    rng = np.random.default_rng(seed)
+    decay = np.exp(-np.arange(n_samples) / (0.1 * constants['Fs']))[:, None]
+    for g in range(n_groups):
+        yield f'rir/{g:03d}', rng.standard_normal([n_samples, n_mics]) * decay
+
+
+def read_patterns(shape, rng):
+    # the selections done by DechorateDataset: one mic, a block of mics, the beginning of all the mics, everything
+    n_samples, n_mics = shape[:2]
+    i = rng.integers(n_mics)
+    lo = rng.integers(max(1, n_mics - 5))
+    return {
+        'one_mic': np.s_[:, i],
+        'five_mics': np.s_[:, lo:lo+5],
+        'first_10pc': np.s_[:n_samples//10, :],
+        'full': np.s_[...],
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", help="Path to the benchmark files and results", type=str)
+    parser.add_argument("--hdf", help="Path to a dEchorate hdf5 dataset (default: synthetic rirs)", type=str, default=None)
+    parser.add_argument("--groups", help="Number of datasets to copy and read", type=int, default=20)
+    parser.add_argument("--repeat", help="Number of reads of each dataset and pattern", type=int, default=3)
+    parser.add_argument("--comp", help="gzip compression level", type=int, default=4)
+    parser.add_argument("--chunk_len", help="Number of samples per chunk (default: whole mic / ~1MiB blocks)", type=int, default=None)
+    args = parser.parse_args()
+
+    path_to_output = Path(args.outdir)
+    assert path_to_output.exists()
+
+    # source data, loaded once in memory
+    if args.hdf is None:
+        data = dict(synthetic_rirs(args.groups, int(1.*constants['Fs']), 31))
+    else:
+        with h5py.File(args.hdf, 'r') as hdf:
+            data = {group: hdf[group][()] for group in get_h5_datasets(hdf)[:args.groups]}
+    n_bytes = sum(x.nbytes for x in data.values())
+    print('Benchmarking', len(data), 'datasets,', n_bytes / 2**20, 'MiB')
+
+    layouts = itertools.product(['auto', 'mic', 'time'], ['gzip', 'lzf', 'none'], [False, True])
+    results = []
+    for chunks, compression, shuffle in tqdm(list(layouts), desc='layout'):
+        if compression == 'none' and shuffle:
+            continue
+        name = f'{chunks}_{compression}' + ('_shuffle' if shuffle else '')
+        path = path_to_output / Path(f'bench_{name}.h5')
+
+        t0 = time.perf_counter()
+        with h5py.File(path, 'w') as hdf:
+            for group, x in data.items():
+                hdf.create_dataset(group, data=x, **h5_storage_options(
+                    x.shape, x.dtype, chunks=chunks, compression=compression,
+                    comp=args.comp, shuffle=shuffle, chunk_len=args.chunk_len))
+        result = {
+            'chunks': chunks,
+            'compression': compression,
+            'shuffle': shuffle,
+            'size_MiB': os.path.getsize(path) / 2**20,
+            'write_MiB/s': n_bytes / 2**20 / (time.perf_counter() - t0),
+        }
+
+        # no chunk cache, so that every read (repeats included) decompresses its chunks
+        rng = np.random.default_rng(0)
+        selections = {group: [read_patterns(x.shape, rng) for r in range(args.repeat)] for group, x in data.items()}
+        for pattern in ['one_mic', 'five_mics', 'first_10pc', 'full']:
+            n_read = 0
+            t0 = time.perf_counter()
+            with h5py.File(path, 'r', rdcc_nbytes=0) as hdf:
+                for group in data:
+                    for sel in selections[group]:
+                        n_read += hdf[group][sel[pattern]].nbytes
+            t = time.perf_counter() - t0
+            result[f'{pattern}_MiB/s'] = n_read / 2**20 / t
+            result[f'{pattern}_ms'] = 1e3 * t / (len(data) * args.repeat)
+        results.append(result)
+        path.unlink()
+
+    df = pd.DataFrame(results)
+    path_to_output_csv = path_to_output / Path('dEchorate_h5_storage_benchmark.csv')
+    df.to_csv(path_to_output_csv)
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.precision', 1):
+        print(df)
+    print('Benchmark saved in', path_to_output_csv)
@@ -5,6 +5,8 @@ import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
 
+from dechorate.utils.file_utils import Manifest, content_hash
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -72,27 +74,40 @@ if __name__ == "__main__":
     })
 
 
-    c = 0  # counter
+    # completed recordings, keyed by their row in the recordings annotation
+    manifest = Manifest(output_dir / Path('dEchorate_database_manifest.jsonl'))
+    calib_sha1 = content_hash(df_pos.to_json())
+    rows = []
 
     print('Compiling an unique database')
     # for each recording
     for r, row in tqdm(df_rec.iterrows(), total=len(df_rec)):
 
+        # done with the same annotation and calibrated positions
+        sha1 = content_hash(row.to_json(), calib_sha1)
+        record = manifest.get(str(r), sha1)
+        if record is not None:
+            rows.extend(record['rows'])
+            continue
+        entries = []
+
         # for each channel in the recordings
         for i in range(31):
 
+            entry = {}
+
             src_id = row['id']
 
-            df.at[c, 'filename'] = row['filename']
-            df.at[c, 'src_id'] = src_id
-            df.at[c, 'src_ch'] = row['channel']
+            entry['filename'] = row['filename']
+            entry['src_id'] = src_id
+            entry['src_ch'] = row['channel']
 
 
             # if silence or diffuse (=noise) skip
             if row['sources'] == 'silence':
-                df.at[c, 'src_pos_x'] = np.nan
-                df.at[c, 'src_pos_y'] = np.nan
-                df.at[c, 'src_pos_z'] = np.nan
+                entry['src_pos_x'] = np.nan
+                entry['src_pos_y'] = np.nan
+                entry['src_pos_z'] = np.nan
 
             else:
                 # find src attributes in pos_note
@@ -116,43 +131,43 @@ if __name__ == "__main__":
 
                     raise ValueError('Too many sources')
 
-                df.at[c, 'src_pos_x'] = float(curr_pos_source['x'].values)
-                df.at[c, 'src_pos_y'] = float(curr_pos_source['y'].values)
-                df.at[c, 'src_pos_z'] = float(curr_pos_source['z'].values)
+                entry['src_pos_x'] = float(curr_pos_source['x'].values)
+                entry['src_pos_y'] = float(curr_pos_source['y'].values)
+                entry['src_pos_z'] = float(curr_pos_source['z'].values)
 
-                df.at[c, 'src_view_x'] = float(curr_pos_source['view_x'].values)
-                df.at[c, 'src_view_y'] = float(curr_pos_source['view_y'].values)
-                df.at[c, 'src_view_z'] = float(curr_pos_source['view_z'].values)
+                entry['src_view_x'] = float(curr_pos_source['view_x'].values)
+                entry['src_view_y'] = float(curr_pos_source['view_y'].values)
+                entry['src_view_z'] = float(curr_pos_source['view_z'].values)
 
 
             if row['id'] >= 4 and row['sources'] == 'directional':
-                df.at[c, 'src_type'] = 'invdirectional'
+                entry['src_type'] = 'invdirectional'
             else:
-                df.at[c, 'src_type'] = row['sources']
-
-            df.at[c, 'src_signal'] = row['signal']
-            df.at[c, 'room_code'] = '%d%d%d%d%d%d' % (row['floor'], row['ceiling'], row['west'], row['south'], row['east'], row['north'])
-            df.at[c, 'room_rfl_floor'] = row['floor']
-            df.at[c, 'room_rfl_ceiling'] = row['ceiling']
-            df.at[c, 'room_rfl_west'] = row['west']
-            df.at[c, 'room_rfl_south'] = row['south']
-            df.at[c, 'room_rfl_east'] = row['east']
-            df.at[c, 'room_rfl_north'] = row['north']
-            df.at[c, 'room_fornitures'] = row['fornitures']
+                entry['src_type'] = row['sources']
+
+            entry['src_signal'] = row['signal']
+            entry['room_code'] = '%d%d%d%d%d%d' % (row['floor'], row['ceiling'], row['west'], row['south'], row['east'], row['north'])
+            entry['room_rfl_floor'] = row['floor']
+            entry['room_rfl_ceiling'] = row['ceiling']
+            entry['room_rfl_west'] = row['west']
+            entry['room_rfl_south'] = row['south']
+            entry['room_rfl_east'] = row['east']
+            entry['room_rfl_north'] = row['north']
+            entry['room_fornitures'] = row['fornitures']
             if row['fornitures']:
-                df.at[c, 'room_code'] = '020002'
+                entry['room_code'] = '020002'
 
-            df.at[c, 'room_temperature'] = row['temperature']
-            df.at[c, 'rec_silence_dB'] = row['silence dB']
-            df.at[c, 'rec_artifacts'] = row['artifacts']
+            entry['room_temperature'] = row['temperature']
+            entry['rec_silence_dB'] = row['silence dB']
+            entry['rec_artifacts'] = row['artifacts']
 
             # find array attributes in pos_note
             if i == 30:
-                df.at[c, 'mic_type'] = 'loopback'
-                df.at[c, 'mic_id'] = i
+                entry['mic_type'] = 'loopback'
+                entry['mic_id'] = i
 
             else:
-                df.at[c, 'mic_type'] = 'capsule'
+                entry['mic_type'] = 'capsule'
 
                 curr_pos_array = df_pos.loc[
                     (df_pos['type'] == 'array')
@@ -166,14 +181,14 @@ if __name__ == "__main__":
                     print(curr_pos_array)
                     ValueError('Too many arrays')
 
-                df.at[c, 'array_id'] = i//5
-                df.at[c, 'array_bar_pos_x'] = float(curr_pos_array['x'].values)
-                df.at[c, 'array_bar_pos_y'] = float(curr_pos_array['y'].values)
-                df.at[c, 'array_bar_pos_z'] = float(curr_pos_array['z'].values)
+                entry['array_id'] = i//5
+                entry['array_bar_pos_x'] = float(curr_pos_array['x'].values)
+                entry['array_bar_pos_y'] = float(curr_pos_array['y'].values)
+                entry['array_bar_pos_z'] = float(curr_pos_array['z'].values)
 
-                df.at[c, 'array_bar_view_x'] = float(curr_pos_array['view_x'].values)
-                df.at[c, 'array_bar_view_y'] = float(curr_pos_array['view_y'].values)
-                df.at[c, 'array_bar_view_z'] = float(curr_pos_array['view_z'].values)
+                entry['array_bar_view_x'] = float(curr_pos_array['view_x'].values)
+                entry['array_bar_view_y'] = float(curr_pos_array['view_y'].values)
+                entry['array_bar_view_z'] = float(curr_pos_array['view_z'].values)
 
                 # find mic attributes in pos_note
                 curr_pos_mic = df_pos.loc[
@@ -189,20 +204,26 @@ if __name__ == "__main__":
                     raise ValueError('Too many microphones')
 
                 curr_mic = int(curr_pos_mic['id'].values[0])
-                df.at[c, 'mic_id'] = curr_pos_mic['id'].values
-                df.at[c, 'mic_ch'] = curr_pos_mic['channel'].values
-                df.at[c, 'mic_pos_x'] = float(curr_pos_mic['x'].values)
-                df.at[c, 'mic_pos_y'] = float(curr_pos_mic['y'].values)
-                df.at[c, 'mic_pos_z'] = float(curr_pos_mic['z'].values)
-                df.at[c, 'mic_view_x'] = float(curr_pos_mic['view_x'].values)
-                df.at[c, 'mic_view_y'] = float(curr_pos_mic['view_y'].values)
-                df.at[c, 'mic_view_z'] = float(curr_pos_mic['view_z'].values)
-
-            c += 1
-
-        if c % 100 == 0:
-            df.to_csv(path_to_output_database)
-
+                entry['mic_id'] = curr_mic
+                entry['mic_ch'] = curr_pos_mic['channel'].values[0]
+                entry['mic_pos_x'] = float(curr_pos_mic['x'].values)
+                entry['mic_pos_y'] = float(curr_pos_mic['y'].values)
+                entry['mic_pos_z'] = float(curr_pos_mic['z'].values)
+                entry['mic_view_x'] = float(curr_pos_mic['view_x'].values)
+                entry['mic_view_y'] = float(curr_pos_mic['view_y'].values)
+                entry['mic_view_z'] = float(curr_pos_mic['view_z'].values)
+
+            entries.append(entry)
+
+        manifest.add(str(r), sha1, rows=entries)
+        rows.extend(entries)
+
+    manifest.close()
+
+    # the database is written once, columns in order of appearance after the initial ones
+    columns = list(df.columns)
+    df = pd.DataFrame(rows)
+    df = df.reindex(columns=columns + [col for col in df.columns if not col in columns])
     df.to_csv(path_to_output_database)
 
     print('done.')
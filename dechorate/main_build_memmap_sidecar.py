@@ -0,0 +1,46 @@
+import h5py
+import argparse
+import numpy as np
+
+from pathlib import Path
+from tqdm import tqdm
+
+from dechorate.utils.file_utils import save_to_memmap_sidecar, get_h5_datasets
+
+
+def h5_attrs_to_json(attrs):
+    out = {}
+    for key, val in attrs.items():
+        if isinstance(val, np.ndarray):
+            val = [v.decode() if isinstance(v, bytes) else v for v in val.tolist()]
+        elif isinstance(val, np.generic):
+            val = val.item()
+        out[key] = val
+    return out
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", help="Path to output files", type=str)
+    parser.add_argument("--hdf", help="Path to a dEchorate hdf5 dataset, e.g. dEchorate_rir.h5", type=str)
+    args = parser.parse_args()
+
+    path_to_output = Path(args.outdir)
+    assert path_to_output.exists()
+    path_to_hdf = Path(args.hdf)
+    assert path_to_hdf.exists()
+
+    # dEchorate_rir.h5 -> dEchorate_rir.json + dEchorate_rir.bin
+    path_to_json = path_to_output / Path(f'{path_to_hdf.stem}.json')
+
+    hdf = h5py.File(path_to_hdf, 'r')
+    groups = get_h5_datasets(hdf)
+    print('Exporting', len(groups), 'datasets from', path_to_hdf)
+
+    # decompress one room/source dataset at the time
+    items = ((group, hdf[group][()]) for group in tqdm(groups, desc='group'))
+    save_to_memmap_sidecar(str(path_to_json), items, attrs=h5_attrs_to_json(hdf.attrs))
+    hdf.close()
+
+    print('Memory-mapped sidecar saved in', path_to_json)
@@ -13,6 +13,7 @@ from tqdm import tqdm
 from dechorate import constants # these are stored in the __init__py file
 from dechorate.stimulus import ProbeSignal
 from dechorate.utils.dsp_utils import *
+from dechorate.utils.file_utils import add_h5_storage_arguments, h5_storage_options_from_args
 
 
 def get_zipped_file(filename, path_to_zipfile, path_to_output):
@@ -98,7 +99,7 @@ if __name__ == "__main__":
     parser.add_argument("--fs", help="Output sampling frequency", type=int)
     parser.add_argument("--datadir", help="Path to dEchorate data folder", type=str)
     parser.add_argument("--dbpath", help="Path to dEchorate annotation database", type=str)
-    parser.add_argument("--comp", help="Compression option for hdf5", type=int, default=4)
+    add_h5_storage_arguments(parser)
     args = parser.parse_args()
 
     signal = args.signal
@@ -178,7 +179,7 @@ if __name__ == "__main__":
         
         n_mics = wav.shape[-1]
         if not new_fs == fs:
-            wav = resample(wav.T, fs, new_fs)
+            wav = resample_poly(wav, fs, new_fs, axis=0)
         assert wav.shape[-1] == n_mics
         
         sanity_check = np.ones(n_mics)
@@ -215,7 +216,7 @@ if __name__ == "__main__":
             hdf.attrs['data_dim_names'] = ["n_samples", "n_mics", "(n_utts)"]
             first_loop = False
         
-        hdf.create_dataset(f'/{signal}/{room_code}/{src_id:d}', data=wav, compression="gzip", compression_opts=args.comp)
+        hdf.create_dataset(f'/{signal}/{room_code}/{src_id:d}', data=wav, **h5_storage_options_from_args(args, wav.shape, wav.dtype))
         # hdf.create_dataset(group, data=wav, compression="gzip", compression_opts=4)
     
     hdf.close()
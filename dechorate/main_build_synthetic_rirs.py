@@ -0,0 +1,136 @@
+import h5py
+import argparse
+import numpy as np
+
+from pathlib import Path
+from tqdm import tqdm
+
+from dechorate import constants # these are stored in the __init__py file
+from dechorate.dataset import SyntheticDataset
+from dechorate.utils.file_utils import add_h5_storage_arguments, h5_storage_options_from_args
+from dechorate.utils.proc_utils import ordered_map
+
+
+def compute_synthetic_rirs(room_code, src_id, room_size, mics, src, Fs, L, c, max_order, echo_order, absb, refl):
+    # synthetic twin of one room/source group: RIRs of all the mics and their echo notes
+    sdset = SyntheticDataset()
+    sdset.set_room_size(room_size)
+    sdset.set_fs(Fs)
+    sdset.set_c(c)
+    sdset.set_dataset(room_code, absb=absb, refl=refl)
+    sdset.set_src(*src)
+
+    sdset.set_k_order(max_order)
+    rirs = sdset.get_rirs(mics, L=L)[:, :, 0]
+
+    # echoes sorted by time of arrival for each mic: n_echo x n_mics
+    # the amplitudes are the heights of the echoes in the rirs (damping / distance)
+    sdset.set_k_order(echo_order)
+    tk, ak, wk, _ = sdset.get_notes(mics)
+    idx = np.argsort(tk, axis=0, kind='stable')
+    toas = np.take_along_axis(tk, idx, axis=0)
+    amps = np.take_along_axis(ak, idx, axis=0)
+    walls = np.take_along_axis(wk, idx, axis=0)
+
+    return room_code, src_id, {
+        f'/echo_toa/{room_code}/{src_id:d}': toas,
+        f'/echo_amp/{room_code}/{src_id:d}': amps,
+        f'/echo_wall/{room_code}/{src_id:d}': walls.astype('S'),
+        f'/rir/{room_code}/{src_id:d}': rirs,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", help="Path to output files", type=str)
+    parser.add_argument("--echo", help="Path to dEchorate_annotations.h5", type=str)
+    parser.add_argument("--order", help="Maximum reflection order of the RIRs", type=int, default=20)
+    parser.add_argument("--echo_order", help="Maximum reflection order of the echo notes", type=int, default=2)
+    parser.add_argument("--absb", help="Absorption coefficient of the walls with absorbent panels", type=float, default=0.9)
+    parser.add_argument("--refl", help="Absorption coefficient of the reflective walls", type=float, default=0.1)
+    parser.add_argument("--workers", help="Number of worker processes", type=int, default=1)
+    add_h5_storage_arguments(parser)
+    args = parser.parse_args()
+
+    curr_dset_name = 'dEchorate_rir_synth'
+
+    # setup paths
+    path_to_output = Path(args.outdir)
+    assert path_to_output.exists()
+    path_to_echo = Path(args.echo)
+    assert path_to_echo.exists()
+
+    # get constants and values
+    room_codes = constants['datasets']
+    Fs = constants['Fs']
+    src_ids = constants['src_ids']
+    c = constants['speed_of_sound']
+    L = int(1.*Fs)
+
+    # calibrated positions
+    with h5py.File(path_to_echo, 'r') as note:
+        room_size = list(note['room_size'][()])
+        mics = note['microphones'][()]
+        srcs = np.concatenate([
+            note['sources_directional_position'][()],
+            note['sources_omnidirection_position'][()]], axis=-1)
+    assert srcs.shape[1] == len(src_ids)
+
+    ## INITIALIZE THE HDF5 DATASET
+    # same structure as dEchorate_rir.h5: /rir/{room_code}/{src_id} : n_samples x n_mics
+    # plus the echo notes /echo_{toa,amp,wall}/{room_code}/{src_id} : n_echo x n_mics
+    # (amplitudes damping / distance as the rirs, dEchorate_annotations.h5 has damping / (4 pi distance))
+    # (there is no loopback channel in the synthetic twin)
+    path_to_output_dataset_h5 = path_to_output / Path(f'{curr_dset_name}.h5')
+    hdf = h5py.File(path_to_output_dataset_h5, 'a')
+
+    params = {
+        'max_order': args.order,
+        'echo_order': args.echo_order,
+        'absb': args.absb,
+        'refl': args.refl,
+        'speed_of_sound': c,
+    }
+    for key, val in params.items():
+        if key in hdf.attrs and hdf.attrs[key] != val:
+            old = hdf.attrs[key]
+            hdf.close()
+            raise ValueError(f'{path_to_output_dataset_h5} was built with {key}={old}, got {val}')
+        hdf.attrs[key] = val
+
+    hdf.attrs['signal'] = 'rirs'
+    hdf.attrs['sampling_rate'] = Fs
+    hdf.attrs['n_samples'] = L
+    hdf.attrs['n_mics'] = mics.shape[1]
+    hdf.attrs['n_utts'] = 1
+    hdf.attrs['n_srcs'] = len(src_ids)
+    hdf.attrs['data_dim_names'] = ["n_samples", "n_mics", "(n_utts)"]
+
+    ## POPULATE THE HDF5 DATASET
+
+    # resume: the rir group is written last, a room/source is done if it exists
+    tasks = [(room_code, src_id) for room_code in room_codes for src_id in src_ids
+             if not f'/rir/{room_code}/{src_id:d}' in hdf]
+    print('Synthesizing', len(tasks), 'room/source groups out of', len(room_codes)*len(src_ids))
+
+    def write(groups):
+        for group, data in groups.items():
+            if group in hdf:
+                del hdf[group]
+            # the chunk layout is for the rirs, the small echo notes keep the automatic one
+            chunks = None if group.startswith('/rir/') else 'auto'
+            hdf.create_dataset(group, data=data, **h5_storage_options_from_args(args, data.shape, data.dtype, chunks=chunks))
+        hdf.flush()
+
+    def task_args(room_code, src_id):
+        return (room_code, int(src_id), room_size, mics, srcs[:, src_id], Fs, L, c,
+                args.order, args.echo_order, args.absb, args.refl)
+
+    # the workers only compute, the main process is the only writer
+    results = ordered_map(compute_synthetic_rirs, [task_args(*task) for task in tasks], args.workers)
+    for _, _, groups in tqdm(results, total=len(tasks), desc="room_code/src_id"):
+        write(groups)
+
+    hdf.close()
+    print('Synthetic RIRs saved in', path_to_output_dataset_h5)
@@ -0,0 +1,71 @@
+import h5py
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from dechorate.utils.ism_utils import perturbed_toa_intervals
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", help="Path to output files", type=str)
+    parser.add_argument("--echo", help="Path to dEchorate_annotations.h5", type=str)
+    parser.add_argument("--order", help="Maximum reflection order of the echoes", type=int, default=2)
+    parser.add_argument("--draws", help="Number of Monte-Carlo geometries", type=int, default=10000)
+    parser.add_argument("--sigma_mics", help="Std of the microphone positions [m]", type=float, default=0.01)
+    parser.add_argument("--sigma_srcs", help="Std of the source positions [m]", type=float, default=0.01)
+    parser.add_argument("--sigma_room", help="Std of the room size [m]", type=float, default=0.)
+    parser.add_argument("--temperature", help="Room temperature [C]", type=float, default=24)
+    parser.add_argument("--sigma_temperature", help="Std of the room temperature [C]", type=float, default=1.)
+    parser.add_argument("--level", help="Probability of the confidence intervals", type=float, default=0.95)
+    parser.add_argument("--bins", help="Number of histogram bins of the quantiles of each echo", type=int, default=256)
+    parser.add_argument("--seed", help="Seed of the random generator", type=int, default=None)
+    args = parser.parse_args()
+
+    # setup paths
+    path_to_output = Path(args.outdir)
+    assert path_to_output.exists()
+    path_to_echo = Path(args.echo)
+    assert path_to_echo.exists()
+    path_to_output_csv = path_to_output / Path('dEchorate_echo_toa_uncertainty.csv')
+
+    # calibrated positions
+    with h5py.File(path_to_echo, 'r') as note:
+        room_size = note['room_size'][()]
+        mics = note['microphones'][()]
+        srcs = np.concatenate([
+            note['sources_directional_position'][()],
+            note['sources_omnidirection_position'][()]], axis=-1)
+
+    # the draws are processed in blocks, only their statistics are kept
+    lower, median, upper, std, toas_nominal, _, walls, orders = perturbed_toa_intervals(
+        room_size, mics, srcs, max_order=args.order, n_draws=args.draws,
+        sigma_mics=args.sigma_mics, sigma_srcs=args.sigma_srcs, sigma_room=args.sigma_room,
+        temperature=args.temperature, sigma_temperature=args.sigma_temperature, seed=args.seed,
+        level=args.level, n_bins=args.bins)
+
+    # one row per echo and mic/source pair
+    K, I, J = toas_nominal.shape
+    k, i, j = [x.ravel() for x in np.meshgrid(np.arange(K), np.arange(I), np.arange(J), indexing='ij')]
+    df = pd.DataFrame({
+        'src_id': j,
+        'mic_id': i,
+        'wall': walls[k, i, j],
+        'order': orders[k],
+        'toa': toas_nominal[k, i, j],
+        'toa_lower': lower[k, i, j],
+        'toa_median': median[k, i, j],
+        'toa_upper': upper[k, i, j],
+        'toa_std': std[k, i, j],
+    })
+    df = df.sort_values(['src_id', 'mic_id', 'toa']).reset_index(drop=True)
+    df.to_csv(path_to_output_csv)
+
+    width = (upper - lower) * 1e3
+    for o in range(args.order + 1):
+        print('order %d: %.0f%% interval width %.3f ms (median), %.3f ms (max)'
+              % (o, 100*args.level, np.median(width[orders == o]), np.max(width[orders == o])))
+    print('Echo toa uncertainty saved in', path_to_output_csv)
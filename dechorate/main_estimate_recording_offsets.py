@@ -0,0 +1,102 @@
+import h5py
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from tqdm import tqdm
+
+from dechorate import constants # these are stored in the __init__py file
+from dechorate.stimulus import ProbeSignal
+from dechorate.utils.dsp_utils import gcc_phat
+
+
+# The offsets hardcoded in __init__.py (recording_offset) are 4444 samples for
+# most of the recordings, and 4444 + 4096 = 8540 or 4444 + 2*4096 = 12636 for a
+# few of them: these were shifted by one or two 4096-sample buffers of the
+# audio interface. The loopback channel goes through the same chain, so its
+# delay with respect to the probe is the typical one plus these shifts:
+#     offset = standard + round(delay - median(delays))
+# gives back the table as long as most of the recordings have the typical
+# delay. The csv has the table value next to the estimate, and the recordings
+# where they disagree are printed.
+
+
+def loopback_delays(dset_chirp, groups, probe, batch=4, max_lag=None):
+    # delays of the loopback channel with respect to the probe,
+    # a batch of recordings is correlated in one fft pass
+    delays = np.zeros(len(groups))
+    for b in tqdm(range(0, len(groups), batch), desc="batch"):
+        loopbacks = []
+        for room_code, src_id in groups[b:b+batch]:
+            data = dset_chirp[f'/chirp/{room_code}/{src_id:d}']
+            loopbacks.append(data[:, data.shape[1]-1])
+        L = max(len(x) for x in loopbacks)
+        loopbacks = np.stack([np.pad(x, (0, L - len(x))) for x in loopbacks], axis=-1)
+        delays[b:b+batch], _ = gcc_phat(probe, loopbacks, max_lag=max_lag)
+    return delays
+
+
+def estimate_offsets(delays, standard):
+    # most of the recordings share the standard offset, the others are
+    # shifted by the difference between their delay and the typical one
+    return standard + np.round(delays - np.median(delays)).astype(int)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", help="Path to output files", type=str)
+    parser.add_argument("--chirps", help="Path to dEchorate_chirp.h5", type=str)
+    parser.add_argument("--batch", help="Number of recordings per fft pass", type=int, default=4)
+    parser.add_argument("--max_delay", help="Maximum delay in seconds", type=float, default=1.)
+    args = parser.parse_args()
+
+    # setup paths
+    path_to_output = Path(args.outdir)
+    assert path_to_output.exists()
+    path_to_chirps = Path(args.chirps)
+    assert path_to_chirps.exists()
+    path_to_output_csv = path_to_output / Path('dEchorate_recording_offsets.csv')
+
+    # get constants and values
+    room_codes = constants['datasets']
+    src_ids = constants['src_ids']
+    Fs = constants['rir_processing']['Fs']
+    assert Fs == constants['Fs']
+
+    # the probe as played
+    ps = ProbeSignal(constants['rir_processing']['stimulus'], Fs)
+    times, s = ps.generate(
+        constants['rir_processing']['n_seconds'],
+        constants['rir_processing']['amplitude'],
+        constants['rir_processing']['n_repetitions'],
+        constants['rir_processing']['silence_at_start'],
+        constants['rir_processing']['silence_at_end'],
+        constants['rir_processing']['sweeprange'])
+
+    dset_chirp = h5py.File(path_to_chirps, "r")
+    groups = [(room_code, src_id) for room_code in room_codes for src_id in src_ids]
+    delays = loopback_delays(dset_chirp, groups, s, batch=args.batch, max_lag=int(args.max_delay*Fs))
+    dset_chirp.close()
+
+    table = constants['recording_offset']
+    standard = table['standard']
+    offsets = estimate_offsets(delays, standard)
+    table_offsets = [table.get(f'/rir/{room_code}/{src_id:d}', standard) for room_code, src_id in groups]
+
+    df = pd.DataFrame({
+        'room_code': [room_code for room_code, _ in groups],
+        'src_id': [src_id for _, src_id in groups],
+        'delay': delays,
+        'offset': offsets,
+        'table_offset': table_offsets,
+    })
+    df.to_csv(path_to_output_csv, index=False)
+
+    diff = df.loc[df['offset'] != df['table_offset']]
+    print(len(diff), 'recordings out of', len(df), 'differ from the offsets in __init__.py')
+    if len(diff) > 0:
+        print(diff.to_string(index=False))
+    print('Recording offsets saved in', path_to_output_csv)
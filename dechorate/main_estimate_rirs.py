@@ -11,18 +11,61 @@ from tqdm import tqdm
 from dechorate import constants # these are stored in the __init__py file
 from dechorate.stimulus import ProbeSignal
 from dechorate.utils.dsp_utils import *
+from dechorate.utils.file_utils import Manifest, content_hash, add_h5_storage_arguments, h5_storage_options_from_args
+from dechorate.utils.proc_utils import ordered_map
 
 rec_offset = constants['recording_offset']
 L = int(1.*constants['Fs'])
 
 
+def get_probe_signal(path_to_cache=None):
+    # the probe is generated once per process (see stimulus.probe_cache)
+    rir_processing = constants['rir_processing']
+    Fs = rir_processing['Fs']
+    assert Fs == constants['Fs']
+    ps = ProbeSignal(rir_processing['stimulus'], Fs, path_to_cache=path_to_cache)
+    ps.generate(
+        rir_processing['n_seconds'],
+        rir_processing['amplitude'],
+        rir_processing['n_repetitions'],
+        rir_processing['silence_at_start'],
+        rir_processing['silence_at_end'],
+        rir_processing['sweeprange'])
+    return ps
+
+
+def estimate_rirs(path_to_chirps, room_code, src_id, offset, path_to_cache=None, channel_block=None, block_size=2**16):
+    # RIRs of all the channels (capsules and loopback) of one room/source chirp recording
+    Fs = constants['Fs']
+    ps = get_probe_signal(path_to_cache)
+    with h5py.File(path_to_chirps, 'r') as dset_chirp:
+        data = dset_chirp[f'/chirp/{room_code}/{src_id:d}']
+        if channel_block is not None:
+            # memory-bounded: channel_block channels of the recording at the time,
+            # only the compensated 1 s window is deconvolved
+            length = min(L, int(5*Fs) - offset)
+            return ps.compute_rir_streaming(data, block_size=block_size, channel_block=channel_block,
+                                            length=length, windowing=False, start=offset)
+        data = np.array(data)
+    rirs = ps.compute_rir(data, windowing=False)[0:int(5*Fs), :]
+
+    # compensate delays
+    return rirs[offset:offset+L, :]
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--outdir", help="Path to output files", type=str)
     parser.add_argument("--dbpath", help="Path to dEchorate database", type=str)
     parser.add_argument("--chirps", help="Path to dEchorate_chirp.h5", type=str)
-    parser.add_argument("--comp", help="Compression option for h5", type=int, default=4)
+    add_h5_storage_arguments(parser)
+    parser.add_argument("--offsets", help="Path to dEchorate_recording_offsets.csv (default: the offsets in __init__.py)", type=str, default=None)
+    parser.add_argument("--workers", help="Number of worker processes deconvolving the recordings", type=int, default=1)
+    parser.add_argument("--channel_block", help="Deconvolve the recordings by blocks of channels to bound the memory (default: all at once)", type=int, default=None)
+    parser.add_argument("--block_size", help="Number of samples read at the time with --channel_block", type=int, default=2**16)
+    parser.add_argument("--cachedir", help="Path to cache the probe signal and its inverse filter", type=str, default=None)
+    parser.add_argument("--verify", help="On resume, also check the stored rirs against the manifest hash", action='store_true')
     args = parser.parse_args()
 
     curr_dset_name = 'dEchorate_rir'
@@ -44,8 +87,14 @@ if __name__ == "__main__":
     # open the database
     df_note = pd.read_csv(path_to_annotation)
 
-    # open the dataset of chirsp
-    dset_chirp = h5py.File(path_to_chirps, "r")
+    # recording offsets estimated by main_estimate_recording_offsets.py
+    if args.offsets is not None:
+        df_offsets = pd.read_csv(args.offsets, dtype={'room_code': str})
+        rec_offset = {
+            f'/rir/{room_code}/{src_id:d}': int(offset)
+            for room_code, src_id, offset in zip(df_offsets['room_code'], df_offsets['src_id'], df_offsets['offset'])
+        }
+        rec_offset['standard'] = constants['recording_offset']['standard']
 
     ## INITIALIZE THE HDF5 DATASET
     # signal = ['chirp', 'silence', 'babble', 'speech', 'noise']
@@ -67,7 +116,81 @@ if __name__ == "__main__":
     
     ## POPULATE THE HDF5 DATASET
 
-    # navigate the chirps dataset
+    # completed room/source groups, appended after each group is written
+    manifest = Manifest(path_to_output / Path(f'{curr_dset_name}_manifest.jsonl'))
+
+    # chirp annotations, indexed once: (room_code, fornitures, src_id, mic_id) -> number of entries
+    df_chirp = df_note.loc[df_note['src_signal'] == 'chirp']
+    n_entries = df_chirp.groupby(['room_code', 'room_fornitures', 'src_id', 'mic_id']).size().to_dict()
+
+    # room/source groups still to estimate
+    tasks = []
+    missing = []
+    with h5py.File(path_to_chirps, 'r') as dset_chirp:
+        for room_code in room_codes:
+            for src_id in src_ids:
+                group = f'/rir/{room_code}/{src_id:d}'
+                # compensate delays (estimated or hardcoded in __init__.py)
+                if group in rec_offset.keys():
+                    d = rec_offset[group]
+                else:
+                    d = rec_offset['standard']
+                # done with the same offset: a group being rewritten has an offset=None record
+                record = manifest.get(group)
+                if record is not None and record['offset'] == d and group in hdf:
+                    if not args.verify or manifest.get(group, sha1=content_hash(hdf[group][()])) is not None:
+                        continue
+
+                if int(room_code) == 20002:
+                    curr_room_code = 20002
+                    curr_fornitures = True
+                else:
+                    curr_room_code = int(room_code)
+                    curr_fornitures = False
+
+                # every channel must have exactly one annotation
+                n_mics = dset_chirp[f'/chirp/{room_code}/{src_id:d}'].shape[1]
+                for i in range(n_mics):
+                    n = n_entries.get((curr_room_code, curr_fornitures, src_id, i), 0)
+                    if n != 1:
+                        missing.append(f'room {room_code} src {src_id} mic {i}: {n} entries')
+
+                tasks.append((str(path_to_chirps), room_code, int(src_id), int(d), args.cachedir, args.channel_block, args.block_size))
+
+    if len(missing) > 0:
+        manifest.close()
+        hdf.close()
+        raise ValueError('Inconsistent chirp annotations in %s:\n%s' % (path_to_annotation, '\n'.join(missing)))
+
+    print('Estimating', len(tasks), 'room/source groups out of', len(room_codes)*len(src_ids))
+
+    # this process is the only writer, the results come back in the order of the tasks
+    results = ordered_map(estimate_rirs, tasks, args.workers)
+    for k, rirs in enumerate(tqdm(results, total=len(tasks), desc="room_code/src_id")):
+        _, room_code, src_id, d, *_ = tasks[k]
+
+        group = f'/rir/{room_code}/{src_id:d}'
+        n_samples, n_mics = rirs.shape
+
+        if not 'n_samples' in hdf.attrs:
+            hdf.attrs['n_samples'] = n_samples
+            hdf.attrs['n_mics'] = n_mics
+            hdf.attrs['n_utts'] = 1
+            hdf.attrs['n_srcs'] = len(src_ids)
+            hdf.attrs['data_dim_names'] = ["n_samples", "n_mics", "(n_utts)"]
+
+        # a group written before a crash, or with another offset, is replaced;
+        # it is invalidated first, so that a crash while rewriting it is not taken for done
+        manifest.add(group, None, offset=None)
+        if group in hdf:
+            del hdf[group]
+        hdf.create_dataset(group, data=rirs, **h5_storage_options_from_args(args, rirs.shape, rirs.dtype))
+        hdf.flush()
+        manifest.add(group, content_hash(rirs), offset=d, n_samples=n_samples, n_mics=n_mics)
+
+    hdf.close()
+
+    # the database is written once, from the manifest
     dt = {
         'signal' : []
     ,   'room_code' : []
@@ -75,106 +198,19 @@ if __name__ == "__main__":
     ,   'mic_id' : []
     ,   'path_hdf5' : []
     }
-    
-    first_loop = True
-
-    for room_code in tqdm(room_codes, desc="room_code"):
-
-        for src_id in tqdm(src_ids, desc="src_id"):
-                
-            group = f'/chirp/{room_code}/{src_id:d}'
-            data = np.array(dset_chirp[group])
-        
-            loopback = data[:,-1]
-
-            # RIR estimation
-            Fs = constants['rir_processing']['Fs']
-            assert Fs == constants['Fs']
-            n_seconds = constants['rir_processing']['n_seconds']
-            amplitude = constants['rir_processing']['amplitude']
-            n_repetitions = constants['rir_processing']['n_repetitions']
-            silence_at_start = constants['rir_processing']['silence_at_start']
-            silence_at_end = constants['rir_processing']['silence_at_end']
-            sweeprange = constants['rir_processing']['sweeprange']
-            stimulus = constants['rir_processing']['stimulus']
-            ps = ProbeSignal(stimulus, Fs)
-            times, s = ps.generate(n_seconds, amplitude, n_repetitions, silence_at_start, silence_at_end, sweeprange)
-            
-            # compute the global delay from the rir with the playback signal
-            try:
-                rir_loop = ps.compute_rir(loopback[:,None], windowing=False)
-                delay = np.argmax(np.abs(rir_loop)) # in samples
-            except:
-                # print(delay)
-                delay = 999999
-
-            n_mics = data.shape[1]
-            rirs = np.zeros([5*Fs, n_mics])
-
+    for room_code in room_codes:
+        for src_id in src_ids:
             group = f'/rir/{room_code}/{src_id:d}'
-
-            for i in tqdm(range(n_mics), desc="i"):
-
-                if int(room_code) == 20002:
-                    curr_room_code = 20002
-                    curr_fornitures = True
-                else:
-                    curr_room_code = room_code
-                    curr_fornitures = False
-
-                info = df_note.loc[
-                    (df_note['src_id'] == float(src_id))
-                &   (df_note['src_signal'] == 'chirp')
-                &   (df_note['room_code'] == int(curr_room_code))
-                &   (df_note['room_fornitures'] == curr_fornitures)
-                &   (df_note['mic_id'] == float(i))
-                ]
-
-                try:
-                    assert len(info) == 1
-                except:
-                    print(room_code, curr_room_code, src_id, i)
-                    print(info)
-                    hdf.close()
-                    exit()
-
-                # # compute the rir
-                if group in hdf:
-                    continue
-                else:
-                    rir = ps.compute_rir(data[:, i, None], windowing=False)
-                    rirs[:,i] = rir[0:int(5*Fs)].squeeze()
-
-
+            record = manifest.get(group)
+            if record is None or record['offset'] is None:
+                continue
+            for i in range(record['n_mics']):
                 dt['signal'].append('rir')
                 dt['room_code'].append(room_code)
                 dt['src_id'].append(src_id)
                 dt['mic_id'].append(i)
                 dt['path_hdf5'].append(group)
+    manifest.close()
 
-            # compensate delays (hardcoded in __init__.py)
-            if group in rec_offset.keys():
-                d = rec_offset[group]
-            else:
-                d = rec_offset['standard']
-
-            rirs = rirs[d:d+L,:]
-            
-            if first_loop:
-                hdf.attrs['n_samples'] = rirs.shape[0]
-                hdf.attrs['n_mics'] = n_mics
-                hdf.attrs['n_utts'] = 1
-                hdf.attrs['n_srcs'] = len(src_ids)
-                hdf.attrs['data_dim_names'] = ["n_samples", "n_mics", "(n_utts)"]
-                first_loop = False
-            
-            if group in hdf:
-                continue
-            else:
-                hdf.create_dataset(group, data=rirs, compression="gzip", compression_opts=args.comp)
-
-            df = pd.DataFrame(dt)
-            df.to_csv(path_to_output / Path('dEchorate_rir_database.csv'))
-            
-
-    hdf.close()
\ No newline at end of file
+    df = pd.DataFrame(dt)
+    df.to_csv(path_to_output / Path('dEchorate_rir_database.csv'))
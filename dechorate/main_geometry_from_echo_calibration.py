@@ -10,6 +10,8 @@ from scipy import stats
 
 from pathlib import Path
 
+from dechorate.utils.ism_utils import speed_of_sound_from_temperature
+
 
 
 if __name__ == "__main__":
@@ -25,7 +27,7 @@ if __name__ == "__main__":
 
     ###############################################################################
     room_temperature = 24
-    speed_of_sound = 331.3 + 0.606 * room_temperature
+    speed_of_sound = speed_of_sound_from_temperature(room_temperature)
 
     ## ROOM SIZE
     room_size = [5.705, 5.965, 2.355]  # meters
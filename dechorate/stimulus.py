@@ -1,20 +1,25 @@
 import numpy as np
+import scipy.fft as fft
 import scipy.signal as sg
 import soundfile as sf
 
 import matplotlib.pyplot as plt
 
+from dechorate.utils.cache_utils import ArrayCache, load_or_compute
 from dechorate.utils.file_utils import save_to_pickle, load_from_matlab
 from dechorate.utils.dsp_utils import *
 
 
+# probes shared by all the ProbeSignal instances of the process
+probe_cache = ArrayCache(max_bytes=2**28)
+
 # =============================================================
 # Credits to PyRirTool
 # https: // github.com/maj4e/pyrirtool/blob/master/stimulus.py
 # =============================================================
 
 class ProbeSignal():
-    def __init__(self, kind='exp_sine_sweep', fs=48000):
+    def __init__(self, kind='exp_sine_sweep', fs=48000, cache=probe_cache, path_to_cache=None, seed=None):
 
         if kind not in ['exp_sine_sweep', 'hadamard_noise', 'white_noise']:
             raise NameError('Excitation type not implemented')
@@ -32,6 +37,18 @@ class ProbeSignal():
 
         self.signal = None
         self.invfilter = None
+        self._invfilter_spectra = {}  # nfft -> rfft of the inverse filter
+
+        # generated probes and inverse filter spectra, keyed by their parameters:
+        # in-memory LRU and optional .npz files named by a parameter hash
+        if not (cache is None or isinstance(cache, ArrayCache)):
+            raise ValueError('cache must be an ArrayCache')
+        self.cache = cache
+        self.path_to_cache = path_to_cache
+        self._key = None
+
+        # white noise generator
+        self.seed = seed
 
         # self.w = load_from_matlab('./data/raw/bp_filt_blackman_4000.mat')['Num'].squeeze()
         self.win_delay = 2000
@@ -40,17 +57,101 @@ class ProbeSignal():
         sf.write(path_to_output, self.signal, self.fs)
 
 
+    def _cached(self, key, compute):
+        # in-memory cache first, then the .npz files named by a hash of the parameters
+        if self.cache is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        value = load_or_compute(self.path_to_cache, key, compute)
+        if self.cache is not None:
+            self.cache.put(key, value)
+        return value
+
     # Generate the stimulus and set requred attributes
     def generate(self, n_seconds, amplitude, n_repetitions, silence_at_start, silence_at_end, sweeprange):
         if self.kind == 'exp_sine_sweep':
-            return self._generate_exponential_sine_sweep(n_seconds, amplitude, sweeprange, silence_at_start, silence_at_end, n_repetitions)
-        # if self.kind == 'white_noise':
-        #     return self._generate_white_noise(n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions)
-        # if self.kind == 'hadamard_noise':
-        #     return self._generate_white_noise(n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions)
+            # the sweep and its inverse filter only depend on the parameters
+            key = (self.kind, self.fs, n_seconds, amplitude, n_repetitions,
+                   silence_at_start, silence_at_end, tuple(float(f) for f in sweeprange))
+
+            def compute():
+                self._generate_exponential_sine_sweep(n_seconds, amplitude, sweeprange, silence_at_start, silence_at_end, n_repetitions)
+                return {
+                    'signal': self.signal,
+                    'invfilter': self.invfilter,
+                    'freq_ranges': np.array(self.freq_ranges),
+                }
+            value = self._cached(key, compute)
+            self.freq_ranges = value['freq_ranges'].tolist()
+            self.ampl_ranges = [-amplitude, amplitude]
+            times, signal = self._set_sweep(value['signal'], value['invfilter'], n_seconds, n_repetitions, silence_at_start, silence_at_end)
+            self._key = key
+            return times, signal
+        # sweeprange is not used by the noise probes
+        if self.kind == 'white_noise':
+            return self._generate_white_noise(n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions)
+        if self.kind == 'hadamard_noise':
+            return self._generate_mls(n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions)
 
         return None
 
+    def _generate_white_noise(self, n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions):
+        fs = self.fs
+        rng = np.random.default_rng(self.seed)
+
+        # each repetition is silence, noise, silence as for the sweep
+        noise = amplitude * rng.uniform(-1, 1, size=[n_repetitions, n_seconds*fs])
+        zerostart = np.zeros([n_repetitions, silence_at_start*fs])
+        zeroend = np.zeros([n_repetitions, silence_at_end*fs])
+        noise = np.concatenate([zerostart, noise, zeroend], axis=1).reshape(-1, 1)
+
+        self.ampl_ranges = [-amplitude, amplitude]
+        self.freq_ranges = [0, fs/2]
+        return self._set_sweep(noise, None, n_seconds, n_repetitions, silence_at_start, silence_at_end)
+
+    def _generate_mls(self, n_seconds, amplitude, silence_at_start, silence_at_end, n_repetitions):
+        fs = self.fs
+
+        # maximum length sequence of period N = 2^m - 1 >= n_seconds
+        m = int(np.ceil(np.log2(n_seconds*fs + 1)))
+        N = 2**m - 1
+        bits = sg.max_len_seq(m)[0].astype(int)
+
+        # the first period brings the room in its periodic steady state
+        mls = amplitude * (1 - 2*bits)
+        mls = np.tile(mls, n_repetitions + 1)
+        zerostart = np.zeros(silence_at_start*fs)
+        zeroend = np.zeros(silence_at_end*fs)
+        mls = np.concatenate([zerostart, mls, zeroend])[:, None]
+
+        # Hadamard indices of the columns and rows of the circulant matrix
+        # A[i, j] = bits[(j - i) mod N], A[i, j] = popcount(rows[i] & cols[j]) mod 2
+        # (Cohn and Lempel, 1977)
+        cols = np.zeros(N, dtype=int)
+        for k in range(m):
+            cols += np.roll(bits, k) << k
+        unit = np.zeros(N + 1, dtype=int)
+        unit[cols] = np.arange(N)
+        rows = np.zeros(N, dtype=int)
+        for k in range(m):
+            rows += bits[(unit[1 << k] - np.arange(N)) % N] << k
+
+        times = np.arange(len(mls))/fs
+        self.total_duration = len(mls)
+        self.invfilter = None
+        self._invfilter_spectra = {}
+        self.n_repetitions = n_repetitions
+        self.signal = mls
+        self.times = times
+        self.n_seconds = n_seconds
+        self.time_ranges = [silence_at_start, silence_at_end]
+        self.ampl_ranges = [-amplitude, amplitude]
+        self.freq_ranges = [0, fs/2]
+        self.mls = {'period': N, 'amplitude': amplitude, 'sum': np.sum(1 - 2*bits), 'rows': rows, 'cols': cols}
+
+        return times.copy(), mls.copy()
+
     def _generate_exponential_sine_sweep(self, n_seconds, amplitude, sweeprange, silence_at_start, silence_at_end, n_repetitions):
         fs = self.fs
 
@@ -98,12 +199,12 @@ class ProbeSignal():
         invfilter = invfilter/amplitude**2/scaling
 
         # fade-in window. Fade out removed because causes ringing - cropping at zero cross instead
-        taperStart = sg.tukey(n_samples, 1/16)
+        taperStart = sg.windows.tukey(n_samples, 1/16)
         taperWindow = np.ones(shape=(n_samples,))
         taperWindow[0:int(n_samples/2)] = taperStart[0:int(n_samples/2)]
         sinsweep = sinsweep*taperWindow
 
-        taperEnding = sg.tukey(n_samples, 1/128)
+        taperEnding = sg.windows.tukey(n_samples, 1/128)
         taperWindow = np.ones(shape=(n_samples,))
         taperWindow[int(n_samples/2):] = taperEnding[int(n_samples/2):]
         sinsweep = sinsweep*taperWindow
@@ -117,11 +218,16 @@ class ProbeSignal():
         sinsweep = np.transpose(
             np.tile(np.transpose(sinsweep), n_repetitions))
 
+        return self._set_sweep(sinsweep, invfilter, n_seconds, n_repetitions, silence_at_start, silence_at_end)
+
+    def _set_sweep(self, sinsweep, invfilter, n_seconds, n_repetitions, silence_at_start, silence_at_end):
+        fs = self.fs
         times = np.arange(len(sinsweep))/fs
 
         # Set the attributes
         self.total_duration = fs*(silence_at_start + n_seconds + silence_at_end)
         self.invfilter = invfilter
+        self._invfilter_spectra = {}
         self.n_repetitions = n_repetitions
         self.signal = sinsweep
         self.times = times
@@ -132,54 +238,205 @@ class ProbeSignal():
         return times.copy(), sinsweep.copy()
 
 
+    def get_invfilter_spectrum(self, nfft):
+        # the spectrum of the inverse filter is computed once per fft size
+        if not nfft in self._invfilter_spectra:
+            def compute():
+                return {'spectrum': fft.rfft(self.invfilter, n=nfft)}
+            if self._key is None:
+                value = compute()
+            else:
+                value = self._cached(self._key + ('invfilter_spectrum', nfft), compute)
+            self._invfilter_spectra[nfft] = value['spectrum']
+        return self._invfilter_spectra[nfft]
+
     def compute_rir(self, recording, windowing=False):
+        '''
+        Deconvolve all the channels of a recording (N x I) at once.
+        The repetitions are averaged before the deconvolution, which is
+        linear, so one real fft per channel is enough.
+        Returns rirs: Lh x I, with Lh = 10 s for every kind of probe. The noise
+        probes only estimate the first period (mls period or repetition) of
+        the rirs, the samples after it are zero.
+        '''
 
         if self.kind == 'exp_sine_sweep':
 
-            assert len(recording.shape)  == 2
+            if len(recording.shape) == 1:
+                recording = recording[:, None]
+            assert len(recording.shape) == 2
             I = recording.shape[1]
             Lr = self.total_duration
-            nfft = 2*Lr
-            Hinv = np.fft.fft(self.invfilter, n=nfft)
+            R = self.n_repetitions
             t = len(self.invfilter)+2*self.fs
             Lh = 10*self.fs
-            rirs = np.zeros(shape=(Lh, I))
-            assert I == 1
-            R = self.n_repetitions
-            for i in range(I):
+            if windowing:
+                # compensate for the windows shift
+                t = t + self.win_delay
 
-                x = recording[:R*Lr, i]
-                x = x.reshape(R, Lr)
+            # linear convolution, no circular aliasing up to t+Lh
+            nfft = fft.next_fast_len(max(Lr + len(self.invfilter) - 1, t + Lh), real=True)
+            Hinv = self.get_invfilter_spectrum(nfft)
 
-                X = np.fft.fft(x, n=nfft)
-                H = np.mean(Hinv * X, 0)
+            x = np.mean(recording[:R*Lr, :].reshape(R, Lr, I), axis=0)
+            H = Hinv[:, None] * fft.rfft(x, n=nfft, axis=0)
 
             if windowing:
-                W = np.fft.fft(self.w, n=nfft)
-                # compensate for the windows shift
-                t = t + self.win_delay
-                rirs[:, i] = np.real(np.fft.ifft(H * W))[t:t+Lh]
-            else:
-                rirs[:, i] = np.real(np.fft.ifft(H))[t:t+Lh]
+                H = H * fft.rfft(self.w, n=nfft)[:, None]
+
+            rirs = fft.irfft(H, n=nfft, axis=0)[t:t+Lh, :]
 
             return rirs
 
+        elif self.kind == 'hadamard_noise':
+
+            if len(recording.shape) == 1:
+                recording = recording[:, None]
+            N = self.mls['period']
+            R = self.n_repetitions
+            t = self.time_ranges[0]*self.fs + N  # skip the transient period
+            Lh = 10*self.fs
+
+            # periodic cross-correlation with the mls through the Hadamard transform:
+            # r[i] = sum_n x[n] y[(n + i) mod N] = FHT(z)[rows[i]] with z[cols[j]] = y[j]
+            y = np.mean(recording[t:t+R*N, :].reshape(R, N, -1), axis=0)
+            z = np.zeros((N + 1, y.shape[1]))
+            z[self.mls['cols']] = y
+            r = fht(z)[self.mls['rows']]
+
+            # the mls autocorrelation is N at lag 0 and -1 elsewhere
+            rirs = (r + self.mls['sum'] * np.sum(y, axis=0)) / (N + 1) / self.mls['amplitude']
+
+            # zero-padded to the length of the sweep rirs
+            rirs = rirs[:Lh]
+            return np.pad(rirs, [(0, Lh - len(rirs)), (0, 0)])
+
+        elif self.kind == 'white_noise':
+
+            if len(recording.shape) == 1:
+                recording = recording[:, None]
+            Lr = self.total_duration
+            R = self.n_repetitions
+            Lh = 10*self.fs
+
+            # cross-spectral (H1) estimate averaged over the repetitions
+            nfft = fft.next_fast_len(Lr, real=True)
+            X = fft.rfft(self.signal[:R*Lr, 0].reshape(R, Lr), n=nfft, axis=1)
+            Y = fft.rfft(recording[:R*Lr, :].reshape(R, Lr, -1), n=nfft, axis=1)
+            Sxy = np.sum(np.conj(X)[:, :, None] * Y, axis=0)
+            Sxx = np.sum(np.abs(X)**2, axis=0)
+            H = Sxy / np.maximum(Sxx, 1e-12 * np.max(Sxx))[:, None]
+
+            rirs = fft.irfft(H, n=nfft, axis=0)[:Lh, :]
+
+            # zero-padded to the length of the sweep rirs
+            return np.pad(rirs, [(0, Lh - len(rirs)), (0, 0)])
+
         else:
             raise NameError('Excitation type not implemented')
 
 
-    def compute_delay(self, y, start=0, duration=10):
-        s = int(start*self.fs)
-        e = s + int(duration*self.fs)
-        x = normalize(center(self.signal[s:e, :]))
-        y = normalize(center(y[s:e, :]))
+    def compute_rir_streaming(self, recording, block_size=2**16, channel_block=8, length=None, windowing=False, out=None, start=0):
+        '''
+        Overlap-save version of compute_rir reading the recording in blocks.
+        recording: anything sliced as recording[start:stop, channels]
+        (numpy array, h5py dataset) or the path to a wav file.
+        Only channel_block channels and one block per repetition are in
+        memory at once, so the peak memory depends on the inverse filter
+        length, block_size and channel_block, not on the recording.
+        The rirs (length x I, default 10 s) starting at sample start of the
+        compute_rir output are written in out (e.g. a h5py dataset) if
+        given, and returned otherwise.
+        '''
+
+        if not self.kind == 'exp_sine_sweep':
+            raise NameError('Excitation type not implemented')
 
-        # Cross-correlation of the two channels (same as convolution with one reversed)
-        corr = sg.correlate(x, y, mode='same')
+        if isinstance(recording, str):
+            wav = sf.SoundFile(recording)
+            n_frames, I = wav.frames, wav.channels
 
-        # Find the offset of the peak. Zero delay would produce a peak at the midpoint
-        delay = int(len(corr)/2) - np.argmax(corr)
-        return delay
+            def read(start, stop, channels):
+                wav.seek(start)
+                return wav.read(stop - start, dtype='float64', always_2d=True)[:, channels]
+        else:
+            wav = None
+            n_frames, I = recording.shape[0], recording.shape[1]
+
+            def read(start, stop, channels):
+                return np.asarray(recording[start:stop, channels], dtype=float)
+
+        Lr = self.total_duration
+        R = self.n_repetitions
+        assert n_frames >= R*Lr
+        t = len(self.invfilter)+2*self.fs + start
+        Lh = 10*self.fs if length is None else length
+
+        M = len(self.invfilter)
+        if windowing:
+            # compensate for the windows shift
+            t = t + self.win_delay
+            M = M + len(self.w) - 1
+        nfft = fft.next_fast_len(M + block_size - 1, real=True)
+        B = nfft - M + 1  # new samples per block
+        H = self.get_invfilter_spectrum(nfft)
+        if windowing:
+            H = H * fft.rfft(self.w, n=nfft)
+        H = H[:, None]
+
+        rirs = np.zeros([Lh, I]) if out is None else None
+        n_blocks = int(np.ceil((t + Lh) / B))
+        for c in range(0, I, channel_block):
+            channels = slice(c, min(c + channel_block, I))
+            C = channels.stop - channels.start
+            rirs_c = np.zeros([Lh, C])
+
+            # the last M-1 input samples and the new block
+            buffer = np.zeros([nfft, C])
+            for k in range(n_blocks):
+                b0, b1 = k*B, min((k+1)*B, Lr)
+                buffer[:-B] = buffer[B:]
+                buffer[-B:] = 0
+                if b0 < Lr:
+                    # average of the repetitions
+                    for r in range(R):
+                        buffer[-B:][:b1-b0] += read(r*Lr + b0, r*Lr + b1, channels)
+                    buffer[-B:] /= R
+
+                # outputs k*B ... (k+1)*B-1, only the ones in [t, t+Lh) are computed
+                if (k+1)*B <= t:
+                    continue
+                y = fft.irfft(fft.rfft(buffer, axis=0) * H, n=nfft, axis=0)[M-1:]
+                lo, hi = max(k*B, t), min((k+1)*B, t + Lh)
+                rirs_c[lo-t:hi-t] = y[lo-k*B:hi-k*B]
+
+            if out is None:
+                rirs[:, channels] = rirs_c
+            else:
+                out[:, channels] = rirs_c
+
+        if wav is not None:
+            wav.close()
+        return rirs
+
+
+    def compute_delay(self, y, start=0, duration=10, phat=True, max_delay=None):
+        '''
+        Subsample delay of each channel of y (N x I) with respect to the probe
+        in the window [start, start+duration] (seconds), with GCC(-PHAT).
+        Positive delays mean that the recording lags the probe.
+        Returns a scalar (float) for a 1-D y and an array of I delays otherwise;
+        the former cross-correlation version returned an integer lag, round the
+        delays where sample offsets are needed.
+        '''
+        s = int(start*self.fs)
+        e = s + int(duration*self.fs)
+        x = center(self.signal[s:e, 0])
+        if len(y.shape) == 1:
+            return float(gcc_phat(x, center(y[s:e]), max_lag=max_delay, phat=phat)[0])
+        y = y[s:e, :] - np.mean(y[s:e, :], axis=0)
+        delays, _ = gcc_phat(x[:, None], y, max_lag=max_delay, phat=phat)
+        return delays
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.signal as sg
 from scipy import stats
 
 from dechorate.utils.dsp_utils import envelope
@@ -110,6 +111,105 @@ def rt60_from_rirs(h, Fs, M, snr=45, do_schroeder=True, val_min=-90):
     return rt60
 
 
+def _nearest_index(X, target, valid):
+    # first index of the value nearest to target (one per column), among the valid samples
+    dist = np.where(valid, np.abs(X - target), np.inf)
+    return np.argmin(dist, axis=0)
+
+
+def _linregress_slope(times, Y, start, stop):
+    # least squares slope of Y[start:stop] vs times[start:stop], column-wise
+    n = np.arange(Y.shape[0])[:, None]
+    w = (n >= start[None, :]) & (n < stop[None, :])
+    t = np.where(w, times[:, None], 0.)
+    y = np.where(w, Y, 0.)
+    N = np.sum(w, axis=0)
+    St, Sy = np.sum(t, axis=0), np.sum(y, axis=0)
+    Stt, Sty = np.sum(t*t, axis=0), np.sum(t*y, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (N*Sty - St*Sy) / (N*Stt - St**2)
+
+
+def _rt60_edt_block(H, Fs, M, snr, do_schroeder, val_min):
+    Lh, N = H.shape
+    eps = np.finfo(float).tiny
+    times = np.arange(Lh)/Fs
+    n = np.arange(Lh)[:, None]
+
+    # 1. envelope with Hilbert's transform, cropped where it reaches val_min dB
+    h_amp = np.abs(sg.hilbert(H, axis=0))
+    h_amp_dB = 20*np.log10(np.maximum(h_amp, eps)/np.max(h_amp, axis=0))
+    start = int(0.100*Fs)
+    idx_min = start + _nearest_index(h_amp_dB[start:], val_min, True)
+    L = np.maximum(start, np.minimum(idx_min, Fs))
+
+    # 2. moving average ('valid' mode on each cropped envelope)
+    csum = np.concatenate([np.zeros((1, N)), np.cumsum(h_amp, axis=0)], axis=0)
+    h_amp_smooth = (csum[M:] - csum[:-M]) / M
+    n = n[:h_amp_smooth.shape[0]]
+    valid = n < (L - M + 1)[None, :]
+    h_amp_smooth = np.where(valid, h_amp_smooth, 0.)
+    E = h_amp_smooth/np.max(h_amp_smooth, axis=0)
+
+    # 3. Schroeder backward integration up to the noise floor
+    snr = 45 if snr > 45 else snr
+    if do_schroeder:
+        EdB = 20*np.log10(np.maximum(E, eps))
+        idx_max = np.argmax(np.where(valid, EdB, -np.inf), axis=0)
+        val_max = EdB[idx_max, np.arange(N)]
+        td = _nearest_index(EdB, val_max - snr, valid & (n >= idx_max[None, :]))
+        valid = n < td[None, :]
+        h_amp_td = np.where(valid, h_amp_smooth, 0.)
+        E = np.cumsum(h_amp_td[::-1], axis=0)[::-1] / np.sum(h_amp_td, axis=0)
+    EdB = np.where(valid, 20*np.log10(np.maximum(E, eps)), -np.inf)
+
+    # 4. linear regressions from max-5dB to max-(snr-10)dB (RT60) and from 0 to -10dB (EDT)
+    idx_max = np.argmax(EdB, axis=0)
+    val_max = EdB[idx_max, np.arange(N)]
+    after_max = valid & (n >= idx_max[None, :])
+    idx_max_less_5 = _nearest_index(EdB, val_max - 5, after_max)
+    idx_max_less_snr_10 = _nearest_index(EdB, val_max - (snr - 10), after_max)
+    idx_max_less_10 = _nearest_index(EdB, val_max - 10, after_max)
+
+    rt60 = -60/_linregress_slope(times[:EdB.shape[0]], EdB, idx_max_less_5, idx_max_less_snr_10)
+    edt = -60/_linregress_slope(times[:EdB.shape[0]], EdB, idx_max, idx_max_less_10)
+    return rt60, edt
+
+
+def rt60_from_rirs_batch(H, Fs, M, snr=45, do_schroeder=True, val_min=-90, bands=None, block=64):
+    '''
+    Vectorized version of rt60_from_rirs for a Lh x N matrix of RIRs.
+    Returns RT60 and EDT per channel (N,), or per octave band and
+    channel (B x N) if the band center frequencies are given.
+    Columns are processed in blocks to bound the memory.
+    '''
+    H = np.asarray(H, dtype=float)
+    if H.ndim == 1:
+        H = H[:, None]
+    Lh, N = H.shape
+
+    if bands is None:
+        rt60 = np.zeros(N)
+        edt = np.zeros(N)
+        for b in range(0, N, block):
+            rt60[b:b+block], edt[b:b+block] = _rt60_edt_block(H[:, b:b+block], Fs, M, snr, do_schroeder, val_min)
+        return rt60, edt
+
+    rt60 = np.zeros([len(bands), N])
+    edt = np.zeros([len(bands), N])
+    for k, fc in enumerate(bands):
+        sos = octave_band_filter(fc, Fs)
+        Hk = sg.sosfiltfilt(sos, H, axis=0)
+        rt60[k], edt[k] = rt60_from_rirs_batch(Hk, Fs, M, snr, do_schroeder, val_min, block=block)
+    return rt60, edt
+
+
+def octave_band_filter(fc, Fs, order=3):
+    lo = fc / np.sqrt(2)
+    hi = min(fc * np.sqrt(2), 0.499*Fs)
+    return sg.butter(order, [lo, hi], btype='bandpass', fs=Fs, output='sos')
+
+
 def compute_mixing_time(rir):
     raise NotImplementedError
 
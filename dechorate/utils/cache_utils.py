@@ -0,0 +1,140 @@
+import os
+import hashlib
+import zipfile
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+from dechorate.utils.file_utils import make_dirs, save_atomic
+
+
+def nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    return 0
+
+
+def set_readonly(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    if isinstance(value, (tuple, list)):
+        for v in value:
+            set_readonly(v)
+    if isinstance(value, dict):
+        for v in value.values():
+            set_readonly(v)
+    return value
+
+
+class ArrayCache():
+    '''
+    In-process LRU cache of decoded numpy arrays with a memory budget.
+    The same instance can be passed to several datasets to share it.
+    The arrays are stored without a copy and put() sets them read-only,
+    the caller's ones included: pass a copy to keep the original writable.
+    '''
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = int(max_bytes)
+        self.n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a pickled cache (e.g. sent to a worker process) starts empty
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            if not key in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._data:
+                self.n_bytes -= nbytes(self._data.pop(key))
+            # items larger than the whole budget are never stored
+            if size > self.max_bytes:
+                return value
+            while self.n_bytes + size > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.n_bytes -= nbytes(old)
+                self.evictions += 1
+            self._data[key] = set_readonly(value)
+            self.n_bytes += size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'n_items': len(self._data),
+            'n_bytes': self.n_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+def load_or_compute(path_to_cache, key, compute, saver='npz'):
+    '''
+    Disk memo of compute(), for cache folders shared by several processes.
+    The file is path_to_cache/<key>.<saver> if key is a string, and is
+    named by the sha1 of repr(key) otherwise.
+    saver:
+        'npz' -- compute() returns a dict of arrays
+        'npy' -- compute() returns an array, loaded back memory-mapped
+    With path_to_cache=None, compute() is just called.
+    '''
+    if not saver in ['npz', 'npy']:
+        raise ValueError('saver must be npz or npy, got %s' % saver)
+    if path_to_cache is None:
+        return compute()
+
+    name = key if isinstance(key, str) else hashlib.sha1(repr(key).encode()).hexdigest()
+    path = os.path.join(path_to_cache, '%s.%s' % (name, saver))
+    if os.path.exists(path):
+        try:
+            if saver == 'npy':
+                return np.load(path, mmap_mode='r')
+            with np.load(path) as npz:
+                return {name: npz[name] for name in npz.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # a corrupt file (e.g. truncated by a crash) is a miss, it is replaced below
+            pass
+
+    value = compute()
+    make_dirs(path_to_cache)
+    # concurrent readers see either no file or the complete one
+    if saver == 'npy':
+        save_atomic(path, np.save, value)
+    else:
+        save_atomic(path, np.savez, **value)
+    return value
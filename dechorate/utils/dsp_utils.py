@@ -1,6 +1,8 @@
-import librosa as lr
+import math
+import functools
 import numpy as np
 import scipy as sp
+import scipy.fft
 import scipy.signal as sg
 
 
@@ -72,5 +74,112 @@ def enforce_toeplitz(A):
     return make_toepliz_as_in_mulan(z, P)
 
 
+@functools.lru_cache(maxsize=None)
+def resample_filter(old_fs, new_fs):
+    '''
+    Rational up/down factors and anti-aliasing FIR for old_fs -> new_fs,
+    designed once per pair of sampling rates (same design as sg.resample_poly)
+    '''
+    g = math.gcd(int(old_fs), int(new_fs))
+    up, down = int(new_fs) // g, int(old_fs) // g
+    max_rate = max(up, down)
+    h = sg.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    h.flags.writeable = False
+    return up, down, h
+
+
+def resample_poly(x, old_fs, new_fs, axis=-1):
+    # polyphase filtering of all the channels in one call
+    up, down, h = resample_filter(old_fs, new_fs)
+    if up == down == 1:
+        return np.array(x)
+    return sg.resample_poly(x, up, down, axis=axis, window=h)
+
+
+def fht(x):
+    '''
+    Fast (Walsh-)Hadamard transform along the first axis, natural (Sylvester)
+    order and no normalization: X[u] = sum_v (-1)^popcount(u & v) x[v].
+    The length must be a power of 2, trailing axes are transformed at once.
+    '''
+    x = np.array(x, dtype=float)
+    N = x.shape[0]
+    if N & (N - 1):
+        raise ValueError('The length must be a power of 2')
+    rest = x.shape[1:]
+    h = 1
+    while h < N:
+        x = x.reshape((N // (2*h), 2, h) + rest)
+        a, b = x[:, 0], x[:, 1]
+        x = np.stack([a + b, a - b], axis=1).reshape((N,) + rest)
+        h *= 2
+    return x
+
+
+def _parabolic_peak(prev, peak, post):
+    # vertex of the parabola through (-1, prev), (0, peak), (1, post)
+    den = prev - 2*peak + post
+    valid = den < 0
+    return np.where(valid, 0.5 * (prev - post) / np.where(valid, den, 1.), 0.)
+
+
+def gcc_phat(x, y, max_lag=None, phat=True, subsample='sinc', half_width=16, upsampling=32):
+    '''
+    Batched generalized cross-correlation (GCC, or GCC-PHAT) delay estimation.
+    x: reference signals N x ..., y: signals M x ..., the trailing axes are
+    broadcast so one reference can be compared to many channels/recordings
+    in one fft pass.
+    subsample: None, 'parabolic' (fit of the 3 samples around the peak) or
+    'sinc' (band-limited interpolation of the correlation around the peak,
+    then parabolic fit on the upsampled grid).
+    Returns the delays of y with respect to x in samples (positive if y lags x)
+    and the correlation values at the peak.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    N, M = x.shape[0], y.shape[0]
+    nfft = sp.fft.next_fast_len(N + M - 1, real=True)
+
+    S = np.conj(sp.fft.rfft(x, n=nfft, axis=0)) * sp.fft.rfft(y, n=nfft, axis=0)
+    if phat:
+        # whitening, the bins far below the peak magnitude (e.g. out of band) stay attenuated
+        mag = np.abs(S)
+        S = S / np.maximum(mag, 1e-6 * np.max(mag, axis=0, keepdims=True))
+    cc = sp.fft.irfft(S, n=nfft, axis=0)
+
+    # lags -(N-1), ..., M-1
+    cc = np.concatenate([cc[nfft-N+1:], cc[:M]], axis=0)
+    lags = np.arange(-(N-1), M)
+    if max_lag is not None:
+        keep = np.abs(lags) <= max_lag
+        cc, lags = cc[keep], lags[keep]
+
+    k = np.argmax(cc, axis=0)
+    peak = np.take_along_axis(cc, k[None], axis=0)[0]
+    delay = lags[k].astype(float)
+    if subsample is None:
+        return delay, peak
+
+    # correlation around the peak, zero outside the lag range
+    W = half_width if subsample == 'sinc' else 1
+    cc = np.concatenate([np.zeros((W,) + cc.shape[1:]), cc, np.zeros((W,) + cc.shape[1:])], axis=0)
+    win = np.stack([np.take_along_axis(cc, (k + W + n)[None], axis=0)[0] for n in range(-W, W+1)], axis=0)
+
+    if subsample == 'parabolic':
+        return delay + _parabolic_peak(win[0], win[1], win[2]), peak
+    if not subsample == 'sinc':
+        raise ValueError('subsample must be None, parabolic or sinc')
+
+    # hann-windowed sinc interpolation on a grid of step 1/upsampling in [-1, 1]
+    n = np.arange(-W, W+1)
+    tau = np.arange(-upsampling, upsampling+1) / upsampling
+    kernel = np.sinc(tau[:, None] - n[None, :]) * np.hanning(2*W+3)[1:-1][None, :]
+    fine = np.tensordot(kernel, win, axes=(1, 0))
+    g = np.clip(np.argmax(fine, axis=0), 1, len(tau) - 2)
+    f = [np.take_along_axis(fine, (g + i)[None], axis=0)[0] for i in [-1, 0, 1]]
+    delay = delay + tau[g] + _parabolic_peak(*f) / upsampling
+    return delay, np.maximum(peak, f[1])
+
+
 def resample(x, old_fs, new_fs):
-    return lr.resample(np.asfortranarray(x), orig_sr=old_fs, target_sr=new_fs).T
+    return resample_poly(x, old_fs, new_fs, axis=-1).T
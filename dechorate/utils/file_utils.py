@@ -1,4 +1,9 @@
 import os
+import json
+import hashlib
+import tempfile
+import h5py
+import numpy as np
 import pickle as pkl
 from scipy.io import loadmat, savemat
 
@@ -21,5 +26,223 @@ def save_to_matlab(filename, obj):
     return savemat(filename, obj)
 
 
+def get_h5_datasets(hdf):
+    # names of all the datasets of an h5py file or group
+    groups = []
+    hdf.visititems(lambda name, obj: groups.append(name) if isinstance(obj, h5py.Dataset) else None)
+    return groups
+
+
 def make_dirs(path):
     os.makedirs(path, exist_ok=True)
+
+
+def save_atomic(path, save, *args, **kwargs):
+    '''
+    save(handle, *args, **kwargs) to a temporary file in the directory of
+    path, then rename it onto path: concurrent readers (e.g. the workers
+    sharing a cache folder) see either no file or the complete one.
+    '''
+    handle = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', suffix='.tmp', delete=False)
+    try:
+        with handle:
+            save(handle, *args, **kwargs)
+        os.replace(handle.name, path)
+    except BaseException:
+        os.unlink(handle.name)
+        raise
+
+
+class MemmapSidecar():
+    '''
+    Read-only view of a dataset exported as one contiguous raw block
+    plus a small JSON index (group -> byte offset, shape, dtype).
+    Indexing returns zero-copy slices of a np.memmap.
+    '''
+    def __init__(self, path_to_json):
+        with open(path_to_json, 'r') as handle:
+            index = json.load(handle)
+        self.path_to_json = path_to_json
+        self.path_to_bin = os.path.join(os.path.dirname(path_to_json), index['path_to_bin'])
+        self.attrs = index['attrs']
+        self.groups = index['groups']
+        self._mm = np.memmap(self.path_to_bin, dtype=np.uint8, mode='r')
+
+    def __contains__(self, group):
+        return group.strip('/') in self.groups
+
+    def __getitem__(self, group):
+        entry = self.groups[group.strip('/')]
+        dtype = np.dtype(entry['dtype'])
+        n_bytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        offset = entry['offset']
+        return self._mm[offset:offset+n_bytes].view(dtype).reshape(entry['shape'])
+
+    def keys(self):
+        return self.groups.keys()
+
+    def close(self):
+        self._mm = None
+
+
+def save_to_memmap_sidecar(path_to_json, items, attrs=None, align=64):
+    '''
+    items is an iterable of (group, np.ndarray), written one after the
+    other in C order and little-endian to a .bin file next to the index.
+    '''
+    path_to_bin = os.path.splitext(path_to_json)[0] + '.bin'
+    index = {
+        'path_to_bin': os.path.basename(path_to_bin),
+        'attrs': {} if attrs is None else attrs,
+        'groups': {},
+    }
+    offset = 0
+    with open(path_to_bin, 'wb') as handle:
+        for group, data in items:
+            data = np.asarray(data)
+            data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+            # keep every block aligned for the memmap views
+            pad = -offset % align
+            handle.write(b'\0' * pad)
+            offset += pad
+            index['groups'][group.strip('/')] = {
+                'offset': offset,
+                'shape': list(data.shape),
+                'dtype': data.dtype.str,
+            }
+            handle.write(data.tobytes())
+            offset += data.nbytes
+
+    with open(path_to_json, 'w') as handle:
+        json.dump(index, handle, indent=1)
+    return index
+
+
+def h5_storage_options(shape, dtype=np.float64, chunks='auto', compression='gzip', comp=4, shuffle=False, chunk_len=None):
+    '''
+    Keyword arguments of h5py create_dataset for a (n_samples x n_mics [x n_utts]) array.
+    chunks:
+        'auto' -- h5py's guess
+        'mic'  -- one column per chunk (chunk_len samples of a mic, all the utterances),
+                  reading a mic decompresses only that mic
+        'time' -- chunk_len samples of all the mics, for reading blocks of channels
+    compression: 'gzip' (level comp), 'lzf' or 'none'
+    '''
+    if not compression in ['gzip', 'lzf', 'none']:
+        raise ValueError('compression must be gzip, lzf or none, got %s' % compression)
+    opts = {}
+    if compression == 'gzip':
+        opts['compression'] = 'gzip'
+        opts['compression_opts'] = comp
+    elif compression == 'lzf':
+        opts['compression'] = 'lzf'
+    if shuffle:
+        opts['shuffle'] = True
+
+    n_samples = shape[0]
+    if chunks == 'mic':
+        L = n_samples if chunk_len is None else chunk_len
+        opts['chunks'] = (max(1, min(L, n_samples)), 1) + tuple(shape[2:])
+    elif chunks == 'time':
+        # ~1 MiB chunks fit the default h5py chunk cache
+        if chunk_len is None:
+            chunk_len = max(1, 2**20 // (int(np.prod(shape[1:])) * np.dtype(dtype).itemsize))
+        opts['chunks'] = (max(1, min(chunk_len, n_samples)),) + tuple(shape[1:])
+    elif chunks != 'auto':
+        raise ValueError('chunks must be auto, mic or time, got %s' % chunks)
+    return opts
+
+
+def add_h5_storage_arguments(parser):
+    # the storage options of the build scripts, see h5_storage_options
+    parser.add_argument("--comp", help="gzip compression level", type=int, default=4)
+    parser.add_argument("--compression", help="h5 compression filter", choices=['gzip', 'lzf', 'none'], default='gzip')
+    parser.add_argument("--shuffle", help="Apply the h5 shuffle filter before compression", action='store_true')
+    parser.add_argument("--chunks", help="h5 chunk layout: auto, one mic per chunk or blocks of samples of all the mics", choices=['auto', 'mic', 'time'], default='auto')
+    parser.add_argument("--chunk_len", help="Number of samples per chunk (default: whole mic / ~1MiB blocks)", type=int, default=None)
+    return parser
+
+
+def h5_storage_options_from_args(args, shape, dtype=np.float64, chunks=None):
+    # chunks overrides args.chunks, e.g. for small datasets next to the signals
+    return h5_storage_options(shape, dtype, chunks=args.chunks if chunks is None else chunks,
+                              compression=args.compression, comp=args.comp,
+                              shuffle=args.shuffle, chunk_len=args.chunk_len)
+
+
+def _to_json(obj):
+    # numpy scalars and arrays in the records
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def content_hash(*items):
+    '''
+    sha1 of a sequence of numpy arrays and json-serializable objects.
+    '''
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            h.update(repr((item.dtype.str, item.shape)).encode())
+            h.update(memoryview(item).cast('B'))
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=_to_json).encode())
+    return h.hexdigest()
+
+
+class Manifest():
+    '''
+    Append-only JSON-lines log of the completed units of a build script.
+    Each line is a record {"key": ..., "sha1": ..., **fields}, the last
+    record of a key wins. A line truncated by a crash is ignored, so a
+    restart can skip the finished units with a dictionary lookup.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        tail = '\n'
+        if os.path.exists(path):
+            with open(path, 'r') as handle:
+                for line in handle:
+                    tail = line[-1:]
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[record['key']] = record
+        self._handle = open(path, 'a')
+        # do not glue the next record to a truncated line
+        if tail != '\n':
+            self._handle.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def get(self, key, sha1=None):
+        # None if the unit is missing or was computed from different content
+        record = self.records.get(key)
+        if record is None or (sha1 is not None and record['sha1'] != sha1):
+            return None
+        return record
+
+    def add(self, key, sha1, **fields):
+        record = {'key': key, 'sha1': sha1, **fields}
+        self._handle.write(json.dumps(record, default=_to_json) + '\n')
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self.records[key] = record
+        return record
+
+    def close(self):
+        self._handle.close()
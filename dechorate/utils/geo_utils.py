@@ -2,7 +2,50 @@ import numpy as np
 import scipy.optimize
 import functools
 
-from sympy import Point3D, Plane, Ray3D
+
+# Planes are (unit normal, offset) pairs, the points x of the plane satisfy
+# normal . x + offset = 0. Points are 3 x N arrays (or single 3-vectors).
+
+def plane_from_normal_and_point(normal, point):
+    normal = np.asarray(normal, dtype=float)
+    normal = normal / np.linalg.norm(normal)
+    return normal, -float(normal @ np.asarray(point, dtype=float))
+
+
+def plane_through_points(points, tol=1e-9):
+    points = np.asarray(points, dtype=float)
+    D, N = points.shape
+    assert D == 3
+    assert N >= 3
+    # the normal is the direction of least variance of the points
+    center = np.mean(points, axis=-1)
+    u, sv, _ = np.linalg.svd(points - center[:, None])
+    scale = max(sv[0], 1.)
+    if sv[1] < tol * scale:
+        raise ValueError('Collinear points')
+    if sv[2] > tol * scale:
+        raise ValueError('Points are not coplanar')
+    return plane_from_normal_and_point(u[:, 2], center)
+
+
+def signed_dist_points_plane(points, plane):
+    normal, offset = plane
+    return normal @ np.asarray(points, dtype=float) + offset
+
+
+def dist_points_plane(points, plane):
+    return np.abs(signed_dist_points_plane(points, plane))
+
+
+def project_on_plane(points, plane):
+    normal, _ = plane
+    return points - np.multiply.outer(normal, signed_dist_points_plane(points, plane))
+
+
+def reflect_on_plane(points, plane):
+    normal, _ = plane
+    return points - 2*np.multiply.outer(normal, signed_dist_points_plane(points, plane))
+
 
 def compute_planes(room_dimension):
     room_dimension = np.array(room_dimension)
@@ -11,33 +54,33 @@ def compute_planes(room_dimension):
     L, W, H = room_dimension
     planes = {
         'd': None,
-        'c': sym_plane_from_points(
+        'c': plane_through_points(
                 np.transpose(np.array([[0, 0, H], [L, 0, H], [0, W, H], [L, W, H]]))),
-        'f': sym_plane_from_points(
+        'f': plane_through_points(
                 np.transpose(np.array([[0, 0, 0], [L, 0, 0], [0, W, 0], [L, W, 0]]))),
-        'w': sym_plane_from_points(
+        'w': plane_through_points(
                 np.transpose(np.array([[0, 0, 0], [0, W, 0], [0, 0, H], [0, W, H]]))),
-        's': sym_plane_from_points(
+        's': plane_through_points(
                 np.transpose(np.array([[0, 0, 0], [L, 0, 0], [0, 0, H], [L, 0, H]]))),
-        'e': sym_plane_from_points(
+        'e': plane_through_points(
                 np.transpose(np.array([[L, 0, 0], [L, W, 0], [L, 0, H], [L, W, H]]))),
-        'n': sym_plane_from_points(
+        'n': plane_through_points(
                 np.transpose(np.array([[0, W, 0], [L, W, 0], [0, W, H], [L, W, H]]))),
     }
     return planes
 
-def get_point(x):
-    return Point3D(list(x))
-
 
 def compute_image(x, P):
-    pnt = get_point(x)
-    prj = P.projection(pnt)
-    img = pnt + 2*Ray3D(pnt, prj).direction
-    return img
+    return reflect_on_plane(np.asarray(x, dtype=float), P)
+
+
+def get_point(x):
+    from sympy import Point3D
+    return Point3D(list(x))
 
 
 def sym_plane_from_points(points):
+    from sympy import Point3D, Plane
     D, N = points.shape
     assert D == 3
     assert N > 3
@@ -45,7 +88,7 @@ def sym_plane_from_points(points):
     pts = [get_point(points[:,n]) for n in range(N)]
 
     if not Point3D.are_coplanar(*pts):
-        raise ValueError('Not complanar')
+        raise ValueError('Points are not coplanar')
 
     pl = Plane(*pts[:3])
 
@@ -0,0 +1,351 @@
+import numpy as np
+
+from functools import lru_cache
+
+# wall code -> (axis, side, name): side 0 is the plane at 0, side 1 the plane at room_size[axis]
+WALLS = {
+    'w': (0, 0, 'west'),
+    'e': (0, 1, 'east'),
+    's': (1, 0, 'south'),
+    'n': (1, 1, 'north'),
+    'f': (2, 0, 'floor'),
+    'c': (2, 1, 'ceiling'),
+}
+
+
+def speed_of_sound_from_temperature(temperature):
+    # linear approximation in dry air, temperature in Celsius
+    return 331.3 + 0.606 * np.asarray(temperature, dtype=float)
+
+
+def get_absorption_from_room_code(room_code, absb=0.2, refl=0.8):
+    # room code digits: floor, ceiling, west, south, east, north
+    f, c, w, s, e, n = [int(i) for i in list(room_code)]
+    return {
+        'north': refl if n else absb,
+        'south': refl if s else absb,
+        'east': refl if e else absb,
+        'west': refl if w else absb,
+        'floor': refl if f else absb,
+        'ceiling': refl if c else absb,
+    }
+
+
+def get_reflection_coeffs(absorption=None):
+    # amplitude reflection coefficient of each wall, 1 - absorption as in pra legacy 'absorption'
+    if absorption is None:
+        return {wall: 1. for wall in WALLS}
+    return {wall: 1. - absorption[WALLS[wall][2]] for wall in WALLS}
+
+
+def first_order_echoes(room_size, mics, srcs, c, absorption=None, walls=['d', 'c', 'f', 'w', 's', 'e', 'n']):
+    '''
+    Closed-form direct path and first order images of a shoebox room
+    for all the mic/source pairs at once.
+    mics: 3 x I, srcs: 3 x J
+    returns toas, amps and wall labels of shape K x I x J, K = len(walls)
+    The amps are damping / (4 pi distance), as in the annotations.
+    '''
+    room_size = np.asarray(room_size, dtype=float)
+    mics = np.asarray(mics, dtype=float).reshape(3, -1)
+    srcs = np.asarray(srcs, dtype=float).reshape(3, -1)
+    I, J = mics.shape[1], srcs.shape[1]
+    K = len(walls)
+    beta = get_reflection_coeffs(absorption)
+
+    # reflect the sources across each plane: K x 3 x J
+    images = np.repeat(srcs[None, :, :], K, axis=0)
+    dampings = np.ones(K)
+    for k, wall in enumerate(walls):
+        if wall == 'd':
+            continue
+        axis, side, _ = WALLS[wall]
+        images[k, axis, :] = 2 * side * room_size[axis] - srcs[axis, :]
+        dampings[k] = beta[wall]
+
+    dist = np.linalg.norm(images[:, :, None, :] - mics[None, :, :, None], axis=1)
+    toas = dist / c
+    amps = dampings[:, None, None] / (4 * np.pi * dist)
+    labels = np.broadcast_to(np.array(walls)[:, None, None], (K, I, J))
+    return toas, amps, labels
+
+
+@lru_cache(maxsize=32)
+def image_source_lattice(max_order):
+    '''
+    Indices of the shoebox image sources up to max_order (Allen and Berkley).
+    Along each axis the image coordinate is (1 - 2p) s + 2 n L and the
+    sound is reflected |n - p| times on the wall at 0 and |n| times on the
+    wall at L.
+    Returns n, p: K x 3 and the orders: K, sorted by order.
+    The lattice only depends on max_order, it is cached and read-only.
+    '''
+    n = np.arange(-max_order, max_order+1)
+    n, p = np.repeat(n, 2), np.tile([0, 1], len(n))
+    o = np.abs(n - p) + np.abs(n)
+    n, p, o = n[o <= max_order], p[o <= max_order], o[o <= max_order]
+
+    # combine the three axes
+    ix, iy, iz = [a.ravel() for a in np.meshgrid(*[np.arange(len(o))]*3, indexing='ij')]
+    orders = o[ix] + o[iy] + o[iz]
+    keep = orders <= max_order
+    ix, iy, iz, orders = ix[keep], iy[keep], iz[keep], orders[keep]
+    idx = np.argsort(orders, kind='stable')
+    lattice_n = np.stack([n[ix], n[iy], n[iz]], axis=-1)[idx]
+    lattice_p = np.stack([p[ix], p[iy], p[iz]], axis=-1)[idx]
+    orders = orders[idx]
+    for a in [lattice_n, lattice_p, orders]:
+        a.flags.writeable = False
+    return lattice_n, lattice_p, orders
+
+
+def get_images(room_size, srcs, lattice_n, lattice_p):
+    # image positions: 3 x K x J
+    room_size = np.asarray(room_size, dtype=float)
+    srcs = np.asarray(srcs, dtype=float).reshape(3, -1)
+    sign = (1 - 2*lattice_p).T[:, :, None]
+    shift = (2*lattice_n*room_size[None, :]).T[:, :, None]
+    return sign*srcs[:, None, :] + shift
+
+
+def get_dampings(lattice_n, lattice_p, absorption=None):
+    # product of the reflection coefficients of all the walls hit: K
+    beta = get_reflection_coeffs(absorption)
+    dampings = np.ones(lattice_n.shape[0])
+    for wall, (axis, side, _) in WALLS.items():
+        if side == 0:
+            counts = np.abs(lattice_n[:, axis] - lattice_p[:, axis])
+        else:
+            counts = np.abs(lattice_n[:, axis])
+        dampings *= beta[wall]**counts
+    return dampings
+
+
+def get_wall_sequences(room_size, images, mics, max_order):
+    '''
+    Generator wall sequence of each image, e.g. 'cw' = ceiling then west,
+    'd' for the direct path.
+    The line from the image to the mic is unfolded in the lattice of rooms:
+    it crosses the planes x = k L (and y, z) once per reflection, on the wall
+    at 0 if k is even and on the wall at L if k is odd, and the crossings are
+    sorted from the source side.
+    images: 3 x K x J, mics: 3 x I, returns K x I x J
+    '''
+    room_size = np.asarray(room_size, dtype=float)
+    mics = np.asarray(mics, dtype=float).reshape(3, -1)
+    K, J = images.shape[1:]
+    I = mics.shape[1]
+    M = max(max_order, 1)
+    offsets = np.arange(M)
+
+    letters = np.array(['w', 'e', 's', 'n', 'f', 'c'])
+    t_all, w_all = [], []
+    for axis in range(3):
+        L = room_size[axis]
+        x_img = images[axis][:, None, :, None]   # K x 1 x J x 1
+        x_mic = mics[axis][None, :, None, None]  # 1 x I x 1 x 1
+        cell = np.floor(x_img / L)
+        k = np.minimum(cell, 0) + 1 + offsets
+        valid = k <= np.maximum(cell, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (k*L - x_img) / (x_mic - x_img)
+        t_all.append(np.where(valid, t, np.inf))
+        w_all.append(np.broadcast_to(2*axis + (k % 2).astype(int), (K, I, J, M)))
+    t_all = np.concatenate(t_all, axis=-1)
+    w_all = np.concatenate(w_all, axis=-1)
+
+    idx = np.argsort(t_all, axis=-1)[..., :M]
+    t_all = np.take_along_axis(t_all, idx, axis=-1)
+    w_all = letters[np.take_along_axis(w_all, idx, axis=-1)]
+
+    sequences = np.full([K, I, J], '', dtype='<U%d' % M)
+    for m in range(M):
+        sequences = np.char.add(sequences, np.where(np.isfinite(t_all[..., m]), w_all[..., m], ''))
+    sequences[sequences == ''] = 'd'
+    return sequences
+
+
+def image_source_model(room_size, mics, srcs, c, max_order, absorption=None, walls=True):
+    '''
+    Vectorized image source model of a shoebox room for all the mic/source
+    pairs at once.
+    mics: 3 x I, srcs: 3 x J
+    Returns toas, amps, wall sequences: K x I x J and the orders: K
+    The amps are damping / (4 pi distance), as in the annotations.
+    '''
+    mics = np.asarray(mics, dtype=float).reshape(3, -1)
+    lattice_n, lattice_p, orders = image_source_lattice(max_order)
+    images = get_images(room_size, srcs, lattice_n, lattice_p)
+    dampings = get_dampings(lattice_n, lattice_p, absorption)
+
+    dist = np.linalg.norm(images[:, :, None, :] - mics[:, None, :, None], axis=0)
+    toas = dist / c
+    amps = dampings[:, None, None] / (4 * np.pi * dist)
+    sequences = get_wall_sequences(room_size, images, mics, max_order) if walls else None
+    return toas, amps, sequences, orders
+
+
+@lru_cache(maxsize=8)
+def fractional_delay_table(fdl=81, n_frac=512):
+    # hann-windowed sincs (as pra.utilities.fractional_delay) for n_frac+1 delays in [-0.5, 0.5]
+    delays = np.linspace(-0.5, 0.5, n_frac+1)
+    table = np.hanning(fdl)[None, :] * np.sinc(np.arange(fdl)[None, :] - (fdl-1)/2 - delays[:, None])
+    table.flags.writeable = False
+    return table
+
+
+def synthesize_rirs(toas, amps, Fs, L=None, fdl=81, n_frac=512, block=2**22):
+    '''
+    Sum of fractional-delayed diracs for a batch of mic/source pairs.
+    Each image contributes amp * windowed sinc centered at toa * Fs, the
+    sincs are read from a precomputed table (linearly interpolated between
+    the n_frac+1 tabulated delays) and accumulated with np.bincount.
+    The time origin is the emission as in SyntheticDataset.get_rir.
+    toas, amps: K x I x J
+    Returns rirs: L x I x J
+    '''
+    toas = np.asarray(toas, dtype=float)
+    amps = np.asarray(amps, dtype=float)
+    K = toas.shape[0]
+    pairs = toas.shape[1:]
+    toas = toas.reshape(K, -1)
+    amps = amps.reshape(K, -1)
+    P = toas.shape[1]
+    fdl2 = (fdl-1) // 2
+    if L is None:
+        L = int(np.ceil(1.05 * Fs * np.max(toas))) + fdl2 + 1
+
+    table = fractional_delay_table(fdl, n_frac)
+    taps = np.arange(-fdl2, fdl2+1)
+    rirs = np.zeros(P * L)
+    # split the images in blocks to bound the memory of the taps
+    n_img = max(1, block // (P * fdl))
+    for k in range(0, K, n_img):
+        t = Fs * toas[k:k+n_img]
+        a = amps[k:k+n_img]
+        time_ip = np.round(t)
+        row = (t - time_ip + 0.5) * n_frac
+        lo = np.minimum(np.floor(row).astype(int), n_frac-1)
+        w = (row - lo)[..., None]
+        h = (1 - w) * table[lo] + w * table[lo+1]
+
+        n = time_ip.astype(int)[..., None] + taps
+        valid = (n >= 0) & (n < L)
+        idx = n + L * np.arange(P)[None, :, None]
+        rirs += np.bincount(idx[valid], weights=(a[..., None] * h)[valid], minlength=P*L)
+    return rirs.reshape(pairs + (L,)).transpose(-1, *range(len(pairs)))
+
+
+def _iter_perturbed_toas(room_size, mics, srcs, lattice_n, lattice_p, n_draws, sigma_mics, sigma_srcs, sigma_room,
+                         temperature, sigma_temperature, rng, block):
+    # toas of blocks of at most block draws: B x K x I x J
+    K, I, J = lattice_n.shape[0], mics.shape[1], srcs.shape[1]
+    sign = (1 - 2*lattice_p)[None, :, :, None]   # 1 x K x 3 x 1
+    for b in range(0, n_draws, block):
+        B = min(block, n_draws - b)
+        mics_b = mics[None] + sigma_mics * rng.standard_normal([B, 3, I])
+        srcs_b = srcs[None] + sigma_srcs * rng.standard_normal([B, 3, J])
+        room_b = room_size[None] + sigma_room * rng.standard_normal([B, 3])
+        c_b = speed_of_sound_from_temperature(temperature + sigma_temperature * rng.standard_normal(B))
+
+        # images: B x K x 3 x J
+        images = sign * srcs_b[:, None] + (2 * lattice_n[None] * room_b[:, None, :])[..., None]
+        dist = np.linalg.norm(images[:, :, :, None, :] - mics_b[:, None, :, :, None], axis=2)
+        yield dist / c_b[:, None, None, None]
+
+
+def sample_perturbed_toas(room_size, mics, srcs, max_order=2, n_draws=1000,
+                          sigma_mics=0.01, sigma_srcs=0.01, sigma_room=0.,
+                          temperature=24, sigma_temperature=1., seed=None, block=256):
+    '''
+    Monte-Carlo propagation of the calibration errors to the echo toas.
+    Each draw perturbs the mic and source positions, the room size and the
+    temperature (hence the speed of sound) with independent gaussian errors
+    (std in meters, scalar or broadcastable to the positions, and Celsius).
+    The images of all the draws are computed on the lattice, in blocks of
+    draws. All the draws are returned, see perturbed_toa_intervals to only
+    keep their statistics.
+    mics: 3 x I, srcs: 3 x J
+    Returns toas: n_draws x K x I x J, the nominal toas, amps and wall sequences: K x I x J and the orders: K
+    '''
+    room_size = np.asarray(room_size, dtype=float)
+    mics = np.asarray(mics, dtype=float).reshape(3, -1)
+    srcs = np.asarray(srcs, dtype=float).reshape(3, -1)
+    rng = np.random.default_rng(seed)
+
+    c = speed_of_sound_from_temperature(temperature)
+    nominal = image_source_model(room_size, mics, srcs, c, max_order)
+    lattice_n, lattice_p, _ = image_source_lattice(max_order)
+
+    toas = np.concatenate(list(_iter_perturbed_toas(
+        room_size, mics, srcs, lattice_n, lattice_p, n_draws, sigma_mics, sigma_srcs, sigma_room,
+        temperature, sigma_temperature, rng, block)))
+    return (toas,) + nominal
+
+
+def perturbed_toa_intervals(room_size, mics, srcs, max_order=2, n_draws=1000,
+                            sigma_mics=0.01, sigma_srcs=0.01, sigma_room=0.,
+                            temperature=24, sigma_temperature=1., seed=None, block=256,
+                            level=0.95, n_bins=256):
+    '''
+    Same draws as sample_perturbed_toas (for the same seed and block), but
+    only the per-echo statistics are kept, so the memory does not depend
+    on n_draws. The quantiles are read from per-echo histograms of n_bins
+    bins spanning three times the range of the first block of draws
+    (the few draws outside fall in the edge bins), interpolated linearly
+    within the bins.
+    Returns the lower bound, the median and the upper bound of the central
+    interval with probability level, the std of the toas,
+    the nominal toas, amps and wall sequences: K x I x J and the orders: K
+    '''
+    room_size = np.asarray(room_size, dtype=float)
+    mics = np.asarray(mics, dtype=float).reshape(3, -1)
+    srcs = np.asarray(srcs, dtype=float).reshape(3, -1)
+    rng = np.random.default_rng(seed)
+
+    c = speed_of_sound_from_temperature(temperature)
+    nominal = image_source_model(room_size, mics, srcs, c, max_order)
+    lattice_n, lattice_p, _ = image_source_lattice(max_order)
+    shape = nominal[0].shape
+    P = nominal[0].size
+    toa0 = nominal[0].reshape(-1)
+
+    counts = np.zeros([P, n_bins])
+    s1, s2 = np.zeros(P), np.zeros(P)
+    lo = None
+    for toas in _iter_perturbed_toas(
+            room_size, mics, srcs, lattice_n, lattice_p, n_draws, sigma_mics, sigma_srcs, sigma_room,
+            temperature, sigma_temperature, rng, block):
+        dev = toas.reshape(toas.shape[0], P) - toa0
+        if lo is None:
+            lo, hi = np.min(dev, axis=0), np.max(dev, axis=0)
+            span = hi - lo + 1e-12
+            lo, width = lo - span, 3 * span / n_bins
+        bins = np.clip(((dev - lo) / width).astype(int), 0, n_bins - 1)
+        counts += np.bincount((bins + n_bins * np.arange(P)).ravel(), minlength=P*n_bins).reshape(P, n_bins)
+        s1 += np.sum(dev, axis=0)
+        s2 += np.sum(dev**2, axis=0)
+
+    cdf = np.cumsum(counts, axis=1)
+    alpha = (1 - level) / 2
+    stats = []
+    for q in [alpha, 0.5, 1 - alpha]:
+        target = q * n_draws
+        idx = np.argmax(cdf >= target, axis=1)
+        before = np.take_along_axis(cdf, idx[:, None], axis=1)[:, 0] - counts[np.arange(P), idx]
+        frac = (target - before) / np.maximum(counts[np.arange(P), idx], 1)
+        stats.append((toa0 + lo + (idx + frac) * width).reshape(shape))
+    mean = s1 / n_draws
+    std = np.sqrt(np.maximum(s2 / n_draws - mean**2, 0)).reshape(shape)
+    return tuple(stats) + (std,) + nominal
+
+
+def echo_confidence_intervals(toas, level=0.95):
+    '''
+    Per-echo confidence intervals of Monte-Carlo toas (n_draws x ...).
+    Returns the lower bound, the median and the upper bound of the central
+    interval with probability level, each of shape toas.shape[1:]
+    '''
+    alpha = (1 - level) / 2
+    lower, median, upper = np.quantile(toas, [alpha, 0.5, 1 - alpha], axis=0)
+    return lower, median, upper
@@ -0,0 +1,23 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def ordered_map(fn, tasks, workers=1):
+    '''
+    Yield fn(*task) for each task, in the order of tasks.
+    With workers > 1 the calls run in a pool of processes, with at most
+    2*workers results waiting for the consumer (e.g. the h5 writer):
+    the output is the same as with one worker, with bounded memory.
+    '''
+    if workers <= 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(fn, *task))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -16,6 +16,9 @@ path_to_chirps="${outdir}/dEchorate_chirp.h5"
 # # # Final calibrated geometry
 # python dechorate/main_geometry_from_echo_calibration.py --outdir ${outdir}
 
+# # # Propagation of the calibration errors to the echo toas (optional)
+# python dechorate/main_calibration_uncertainty.py --outdir ${outdir} --echo ${outdir}/dEchorate_annotations.h5 --draws 10000
+
 # # # Build the complete database with recordings 
 # python dechorate/main_build_annotation_database.py --outdir ${outdir} --datadir $path_to_data_dir --calibnote $path_to_calibrated_positions_notes
 
@@ -27,8 +30,22 @@ path_to_chirps="${outdir}/dEchorate_chirp.h5"
 # python dechorate/main_build_sound_datasets.py --outdir ${outdir} --signal noise   --fs 16000 --datadir $path_to_data_dir --dbpath $path_to_database --comp 7
 # # echo "you may want to delete the content of .cache folder"
 
+# # # # Estimate the recording offsets (optional, default: hardcoded in __init__.py)
+# python dechorate/main_estimate_recording_offsets.py --outdir ${outdir} --chirps ${path_to_chirps}
+
 # # # # Estimate RIRs
-# python dechorate/main_estimate_rirs.py --outdir ${outdir} --dbpath ${path_to_database} --chirps ${path_to_chirps} --comp 7
+# python dechorate/main_estimate_rirs.py --outdir ${outdir} --dbpath ${path_to_database} --chirps ${path_to_chirps} --comp 7 # --offsets ${outdir}/dEchorate_recording_offsets.csv --channel_block 4 (small memory nodes)
+
+# # # Synthetic twin of the RIRs from the calibrated geometry (optional)
+# python dechorate/main_build_synthetic_rirs.py --outdir ${outdir} --echo ${outdir}/dEchorate_annotations.h5 --workers 8 --comp 7
+
+# # # Read throughput of the h5 chunk layouts and filters (optional), see --chunks --compression --shuffle
+# python dechorate/main_benchmark_h5_storage.py --outdir ${outdir} --hdf ${outdir}/dEchorate_rir.h5 --comp 7
+
+# # # Uncompressed memory-mapped sidecars for fast random access (optional)
+# for signal in rir speech; do
+#     python dechorate/main_build_memmap_sidecar.py --outdir ${outdir} --hdf ${outdir}/dEchorate_${signal}.h5
+# done
 
 # Convert it into Sofa format
 mkdir -p "${outdir}/sofa/"
@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+
+from dechorate.utils.acu_utils import *
+
+
+def synthetic_rirs(rt60s, Fs):
+    rng = np.random.default_rng(0)
+    t = np.arange(Fs)/Fs
+    H = np.zeros([Fs, len(rt60s)])
+    for n, rt60 in enumerate(rt60s):
+        H[:, n] = rng.standard_normal(Fs) * np.exp(-3*np.log(10)*t/rt60) + 1e-5*rng.standard_normal(Fs)
+        H[:200, n] = 0
+        H[200, n] = 3
+    return H
+
+
+def test_rt60_from_rirs_batch():
+    Fs = 48000
+    rt60s = [0.2, 0.5, 0.8]
+    H = synthetic_rirs(rt60s, Fs)
+
+    rt60, edt = rt60_from_rirs_batch(H, Fs, M=100)
+    assert rt60.shape == edt.shape == (3,)
+    for n in range(H.shape[1]):
+        assert np.allclose(rt60[n], rt60_from_rirs(H[:, n].copy(), Fs, M=100), rtol=0.03)
+    assert np.allclose(rt60, rt60s, rtol=0.1)
+    assert np.allclose(edt, rt60s, rtol=0.15)
+
+    # same results when processed in blocks
+    rt60_b, _ = rt60_from_rirs_batch(H, Fs, M=100, block=2)
+    assert np.allclose(rt60, rt60_b)
+
+
+def test_rt60_from_rirs_batch_octave_bands():
+    Fs = 48000
+    H = synthetic_rirs([0.3, 0.6], Fs)
+    rt60, edt = rt60_from_rirs_batch(H, Fs, M=100, bands=[500, 1000, 2000, 4000])
+    assert rt60.shape == edt.shape == (4, 2)
+    assert np.allclose(rt60, [0.3, 0.6], rtol=0.25)
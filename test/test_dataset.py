@@ -0,0 +1,347 @@
+import os
+import h5py
+import pickle
+import multiprocessing as mp
+import pytest
+import numpy as np
+
+from dechorate import constants
+from dechorate.dataset import DechorateDataset
+from dechorate.utils.cache_utils import ArrayCache, load_or_compute
+from dechorate.utils.dsp_utils import resample, resample_poly, resample_filter
+from dechorate.utils.file_utils import save_to_pickle, save_to_memmap_sidecar, Manifest, content_hash, h5_storage_options
+
+path_to_note = './data/dEchorate_database.csv'
+
+
+def make_dataset(tmp_path, **kwargs):
+    path_to_data = str(tmp_path / 'dEchorate_rir.hdf5')
+    path_to_speech = str(tmp_path / 'dEchorate_speech.h5')
+    rng = np.random.default_rng(0)
+    if not (tmp_path / 'dEchorate_rir.hdf5').exists():
+        with h5py.File(path_to_data, 'w') as hdf:
+            for room_code in constants['datasets'][:2]:
+                for j in range(9):
+                    data = rng.standard_normal([1000, 31])
+                    hdf.create_dataset('/rir/%s/%d' % (room_code, j), data=data, compression='gzip')
+        with h5py.File(path_to_speech, 'w') as hdf:
+            for room_code in constants['datasets'][:2]:
+                for j in range(9):
+                    data = rng.standard_normal([2000, 31, 3])
+                    hdf.create_dataset('/speech/%s/%d' % (room_code, j), data=data, compression='gzip')
+
+    path_to_mic_src_note = str(tmp_path / 'mic_src_echo_note.pkl')
+    save_to_pickle(path_to_mic_src_note, {
+        'mics': rng.random([3, 30]),
+        'srcs': rng.random([3, 9]),
+        'toa_pck': rng.random([7, 30, 9]),
+    })
+    return DechorateDataset(path_to_data, path_to_note, path_to_mic_src_note, None,
+                            path_to_recordings={'speech': path_to_speech}, **kwargs)
+
+
+@pytest.fixture
+def dset(tmp_path):
+    return make_dataset(tmp_path)
+
+
+def test_get_entry(dset):
+    df = dset.dset_note
+    for room_code in ['010000', '020002']:
+        dset.set_entry(room_code, 4, 2)
+        entry = dset.get_entry('chirp')
+        assert len(entry) == 1
+        expected = df.loc[
+              (df['room_code'] == int(room_code))
+            & (df['src_id'] == 3)
+            & (df['mic_id'] == 5)
+            & (df['src_signal'] == 'chirp')
+        ]
+        assert entry.index.equals(expected.index)
+
+
+def test_get_entries(dset):
+    entries = dset.get_entries(['000000', '011100'], np.arange(30), [0, 8], 'speech')
+    assert len(entries) == 2*30*2
+    assert set(entries['src_id']) == {1, 9}
+    assert set(entries['room_code']) == {0, 11100}
+    with pytest.raises(ValueError):
+        dset.get_entries(['000000'], [0], [0], 'sweep')
+
+
+def test_get_rirs(dset):
+    rooms = ['000000', '010000']
+    mics = [3, 0, 7]
+    srcs = [8, 1]
+    rirs = dset.get_rirs(rooms, mics, srcs, length=500)
+    assert rirs.shape == (500, 3, 2, 2)
+    for d, room_code in enumerate(rooms):
+        for j, src in enumerate(srcs):
+            for i, mic in enumerate(mics):
+                dset.set_entry(room_code, mic, src)
+                assert np.allclose(rirs[:, i, j, d], dset.get_rir()[:500])
+
+    rirs = dset.get_rirs(rooms, mics, srcs, length=1200)
+    assert np.allclose(rirs[1000:], 0)
+
+
+def test_array_cache():
+    cache = ArrayCache(max_bytes=3*800)
+    for k in range(4):
+        cache.put(k, np.zeros(100))
+    assert cache.get(0) is None
+    assert cache.get(3) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.n_bytes == 3*800
+
+    cache.get(1)  # 1 is now the most recent, 2 goes next
+    cache.put(4, np.zeros(100))
+    assert 1 in cache and not 2 in cache
+
+    cache.put(5, np.zeros(1000))  # larger than the budget
+    assert not 5 in cache
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 1, 2)
+
+
+def test_load_or_compute(tmp_path):
+    calls = []
+    def compute():
+        calls.append(len(calls))
+        return {'x': np.arange(10.), 'y': np.ones([3, 2])}
+
+    assert np.allclose(load_or_compute(None, ('a', 1), compute)['x'], np.arange(10))
+    for _ in range(2):
+        value = load_or_compute(str(tmp_path), ('a', 1), compute)
+        assert np.allclose(value['x'], np.arange(10)) and np.allclose(value['y'], 1)
+    assert len(calls) == 2
+    path, = tmp_path.glob('*.npz')
+
+    # a file truncated by a concurrent writer is a miss, and is replaced
+    path.write_bytes(path.read_bytes()[:100])
+    assert np.allclose(load_or_compute(str(tmp_path), ('a', 1), compute)['y'], 1)
+    assert len(calls) == 3
+    with np.load(path) as npz:
+        assert np.allclose(npz['x'], np.arange(10))
+
+    # npy files named by a string key, served memory-mapped
+    path = tmp_path / '16000' / '010000_5.npy'
+    compute = lambda: calls.append(len(calls)) or np.arange(6.).reshape(3, 2)
+    load_or_compute(str(path.parent), '010000_5', compute, saver='npy')
+    path.write_bytes(path.read_bytes()[:100])
+    assert np.allclose(load_or_compute(str(path.parent), '010000_5', compute, saver='npy')[2], [4, 5])
+    rirs = load_or_compute(str(path.parent), '010000_5', compute, saver='npy')
+    assert isinstance(rirs, np.memmap) and np.allclose(rirs[2], [4, 5])
+    assert len(calls) == 5
+    assert len(list(tmp_path.rglob('*.tmp'))) == 0
+
+
+def test_shared_cache(tmp_path):
+    cache = ArrayCache(max_bytes=2**24)
+    dset1 = make_dataset(tmp_path, cache=cache)
+    dset2 = make_dataset(tmp_path, cache=cache)
+    nocache = make_dataset(tmp_path)
+
+    for d in [dset1, dset2, nocache]:
+        d.set_entry('010000', 3, 2)
+    rir = nocache.get_rir()
+    assert np.allclose(dset1.get_rir(), rir)
+    assert np.allclose(dset2.get_rir(), rir)
+    assert np.allclose(dset2.get_recording('speech'), nocache.get_recording('speech'))
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['hits'] == 1
+
+    rirs = dset1.get_rirs(['010000'], [0, 5], [2], length=500)
+    assert np.allclose(rirs, nocache.get_rirs(['010000'], [0, 5], [2], length=500))
+    assert cache.stats()['hits'] == 2
+
+
+def test_memmap_sidecar(tmp_path):
+    dset = make_dataset(tmp_path)
+    path_to_json = str(tmp_path / 'dEchorate_rir.json')
+    hdf = dset.dset_data
+    groups = ['rir/%s/%d' % (room_code, j) for room_code in constants['datasets'][:2] for j in range(9)]
+    save_to_memmap_sidecar(path_to_json, ((group, hdf[group][()]) for group in groups))
+
+    mdset = DechorateDataset(path_to_json, path_to_note, dset.path_to_mic_src_note, None)
+    for d in [dset, mdset]:
+        d.set_entry('000000', 7, 4)
+    rir = mdset.get_rir()
+    assert not rir.flags.owndata
+    assert np.allclose(rir, dset.get_rir())
+    assert np.allclose(mdset.get_rirs(['010000', '000000'], [4, 1], [0, 8]),
+                       dset.get_rirs(['010000', '000000'], [4, 1], [0, 8]))
+
+
+def test_manifest(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    x = np.arange(10.)
+    with Manifest(path) as manifest:
+        manifest.add('a', content_hash(x), n=np.int64(10))
+        manifest.add('b', content_hash(x, 'b'))
+        manifest.add('a', content_hash(x + 1), n=10)
+
+    # a crash while writing the last record
+    with open(path, 'a') as handle:
+        handle.write('{"key": "c", "sh')
+
+    with Manifest(path) as manifest:
+        assert len(manifest) == 2 and not 'c' in manifest
+        assert manifest.get('a', content_hash(x)) is None
+        assert manifest.get('a', content_hash(x + 1))['n'] == 10
+        manifest.add('c', content_hash(x))
+    with Manifest(path) as manifest:
+        assert 'c' in manifest and len(manifest) == 3
+
+
+def test_h5_storage_options(tmp_path):
+    x = np.random.randn(1000, 31, 3)
+    with h5py.File(str(tmp_path / 'storage.h5'), 'w') as hdf:
+        for chunks, compression in [('mic', 'lzf'), ('time', 'gzip'), ('auto', 'none')]:
+            hdf.create_dataset(chunks, data=x, **h5_storage_options(
+                x.shape, x.dtype, chunks=chunks, compression=compression, shuffle=compression != 'none', chunk_len=256))
+        assert hdf['mic'].chunks == (256, 1, 3) and hdf['mic'].shuffle
+        assert hdf['time'].chunks == (256, 31, 3) and hdf['time'].compression == 'gzip'
+        assert hdf['auto'].chunks is None
+        for chunks in ['mic', 'time', 'auto']:
+            assert np.array_equal(hdf[chunks][:, 7], x[:, 7])
+    with pytest.raises(ValueError):
+        h5_storage_options(x.shape, compression='zstd')
+
+
+def test_resample_poly():
+    Fs, Fs_new = 48000, 16000
+    t = np.arange(Fs)/Fs
+    x = np.stack([np.sin(2*np.pi*440*t), np.cos(2*np.pi*1000*t)], axis=-1)
+    y = resample_poly(x, Fs, Fs_new, axis=0)
+    assert y.shape == (Fs_new, 2)
+    t = np.arange(Fs_new)/Fs_new
+    assert np.allclose(y[100:-100, 0], np.sin(2*np.pi*440*t)[100:-100], atol=1e-3)
+    assert resample_filter(Fs, Fs_new) is resample_filter(Fs, Fs_new)
+    # legacy interface: time along the last axis, transposed output
+    assert np.allclose(resample(x.T, Fs, Fs_new), y)
+
+
+def test_get_rir_resampled(tmp_path):
+    dset = make_dataset(tmp_path, path_to_resampled=str(tmp_path / 'resampled'), cache=ArrayCache())
+    dset.set_entry('010000', 2, 5)
+    rir = dset.get_rir(Fs_new=16000)
+    assert rir.shape == (334,)
+    assert (tmp_path / 'resampled' / '16000' / '010000_5.npy').exists()
+    rirs = dset.get_rirs(['010000'], [2], [5], Fs_new=16000)
+    assert np.allclose(rirs[:, 0, 0, 0], rir)
+
+    # served from disk by a fresh dataset
+    dset = make_dataset(tmp_path, path_to_resampled=str(tmp_path / 'resampled'))
+    dset.set_entry('010000', 2, 5)
+    assert np.allclose(dset.get_rir(Fs_new=16000), rir)
+
+
+def _read_rir_in_worker(args):
+    dset, mic = args
+    dset.set_entry('010000', mic, 3)
+    return os.getpid(), dset.get_rir()
+
+
+def test_multiprocess_reads(tmp_path):
+    dset = make_dataset(tmp_path, cache=ArrayCache())
+    dset.set_entry('010000', 0, 3)
+    dset.get_rir()  # parent handle is open
+
+    clone = pickle.loads(pickle.dumps(dset))
+    assert clone._files == {} and len(clone.cache) == 0
+    clone.set_entry('010000', 0, 3)
+    assert np.allclose(clone.get_rir(), dset.get_rir())
+
+    for method in ['fork', 'spawn']:
+        with mp.get_context(method).Pool(2) as pool:
+            out = pool.map(_read_rir_in_worker, [(dset, i) for i in range(6)])
+        for i, (pid, rir) in enumerate(out):
+            assert pid != os.getpid()
+            dset.set_entry('010000', i, 3)
+            assert np.allclose(rir, dset.get_rir())
+    dset.close()
+
+
+def test_iter_entries(dset):
+    rooms = ['000000', '010000']
+    mics = [2, 0, 9]
+    srcs = [1, 4, 6]
+    batches = list(dset.iter_entries(rooms, ['rir', 'speech'], mics, srcs, batch_size=4, queue_depth=3))
+    # 6 rir groups -> 4 + 2, 6 speech groups -> 4 + 2
+    assert [len(b[-1]) for b in batches] == [4, 2, 4, 2]
+
+    data, mic_pos, src_pos, toas, amps, info = batches[1]
+    assert data.shape == (2, 1000, 3)
+    assert mic_pos.shape == (2, 3, 3)
+    assert toas.shape == amps.shape == (2, 7, 3)
+    assert info == [('rir', '010000', 4), ('rir', '010000', 6)]
+    assert np.allclose(data, dset.get_rirs(['010000'], mics, [4, 6]).transpose(2, 0, 1, 3)[..., 0])
+    assert np.allclose(src_pos[0], dset.mic_src_echo_note['srcs'][:, 4])
+    assert np.allclose(toas[1], dset.mic_src_echo_note['toa_pck'][:, mics, 6])
+
+    data, _, _, _, _, info = batches[2]
+    assert data.shape == (4, 2000, 3, 3)
+    dset.set_entry(info[3][1], 0, info[3][2])
+    assert np.allclose(data[3, :, 1], dset.get_recording('speech'))
+
+
+def test_iter_entries_noise_signals(tmp_path):
+    dset = make_dataset(tmp_path)
+    rng = np.random.default_rng(1)
+    recordings = {}
+    for signal, src_ids in [('silence', constants['silence_ids']), ('babble', constants['nse_ids'])]:
+        path = str(tmp_path / ('dEchorate_%s.h5' % signal))
+        with h5py.File(path, 'w') as hdf:
+            for room_code in constants['datasets'][:2]:
+                for j in src_ids:
+                    data = rng.standard_normal([500, 31, 2])
+                    hdf.create_dataset('/%s/%s/%d' % (signal, room_code, j), data=data)
+                    recordings[(signal, room_code, j)] = data
+        dset.path_to_recordings[signal] = path
+
+    rooms = list(constants['datasets'][:2])
+    batches = list(dset.iter_entries(rooms, ['silence', 'babble'], [4, 1], batch_size=3))
+    info = [unit for batch in batches for unit in batch[-1]]
+    assert sorted(info) == sorted(recordings.keys())
+    for data, _, src_pos, _, _, units in batches:
+        assert np.all(np.isnan(src_pos))
+        for b, unit in enumerate(units):
+            assert np.allclose(data[b], recordings[unit][:, [4, 1]])
+
+    # the explicit srcs are restricted to the noise sources
+    batches = list(dset.iter_entries(rooms[:1], ['babble'], [0], srcs=[2, 7]))
+    assert [b[-1] for b in batches] == [[('babble', rooms[0], 2)]]
+
+
+def test_synth_echoes(dset):
+    toas, amps, walls = dset.get_synth_echoes('011000')
+    assert toas.shape == amps.shape == walls.shape == (7, 30, 9)
+    dset.set_entry('011000', 12, 5)
+    assert np.allclose(dset.get_echo(kind='sym'), np.sort(toas[:, 12, 5]))
+    assert np.allclose(dset.get_synth_echo(['d', 'c']), toas[:2, 12, 5])
+    assert dset.get_synth_echoes('011000') is dset.get_synth_echoes('011000')
+
+
+def test_echo_note(dset):
+    dset.set_entry('011110', 3, 2)
+    toas, amps, walls = dset.get_echo_note(3)
+    assert len(toas) == len(amps) == len(walls) == 63
+    assert np.all(np.diff(toas) >= 0)
+    assert walls[0] == 'd'
+    first_order = np.array([len(w) == 1 for w in walls])
+    assert np.allclose(toas[first_order], dset.get_echo(kind='sym'))
+    assert np.allclose(dset.get_echo(kind='sym', order=3), toas)
+    assert dset.get_echo_note(3) is dset.get_echo_note(3)
+
+    # the same echoes from SyntheticDataset, whose amps are damping / distance
+    toas, amps, walls = dset.get_echo_note(1)
+    taus, synth_amps, synth_walls = dset.get_synth_note()
+    assert list(synth_walls) == list(walls)
+    assert np.allclose(taus, toas)
+    assert np.allclose(synth_amps, 4 * np.pi * amps)
+    _, amps, walls = dset.get_synth_echoes()
+    for k, wall in enumerate(walls[:, 3, 2]):
+        assert np.isclose(synth_amps[list(synth_walls).index(wall)], 4 * np.pi * amps[k, 3, 2])
+    assert np.allclose(dset.get_echo(kind='sym', order=1), dset.get_echo(kind='sym'))
+    with pytest.raises(ValueError, match='up to order 1'):
+        dset.get_echo(kind='pck', order=2)
@@ -0,0 +1,320 @@
+import pytest
+import numpy as np
+import pyroomacoustics as pra
+
+from dechorate import constants
+from dechorate.dataset import SyntheticDataset
+from dechorate.utils.ism_utils import *
+
+
+def make_pra_room(room_size, mics, srcs, absorption, max_order, fs=48000):
+    materials = {wall: pra.Material(1 - (1 - absorption[wall])**2) for wall in absorption}
+    room = pra.ShoeBox(room_size, fs=fs, materials=materials, max_order=max_order)
+    room.add_microphone_array(pra.MicrophoneArray(mics, room.fs))
+    for j in range(srcs.shape[1]):
+        room.add_source(srcs[:, j])
+    room.image_source_model()
+    return room
+
+
+def random_setup(I, J, rng):
+    room_size = np.array(constants['room_size'])
+    mics = 0.1 + (room_size[:, None] - 0.2) * rng.random([3, I])
+    srcs = 0.1 + (room_size[:, None] - 0.2) * rng.random([3, J])
+    absorption = get_absorption_from_room_code('011010', absb=0.7, refl=0.1)
+    return room_size, mics, srcs, absorption
+
+
+def test_first_order_echoes():
+    room_size, mics, srcs, absorption = random_setup(4, 3, np.random.default_rng(0))
+    c = constants['speed_of_sound']
+    toas, amps, walls = first_order_echoes(room_size, mics, srcs, c, absorption)
+    assert toas.shape == amps.shape == walls.shape == (7, 4, 3)
+    assert np.all(walls[:, 0, 0] == np.array(constants['refl_order_calibr']))
+
+    room = make_pra_room(room_size, mics, srcs, absorption, max_order=1)
+    for j, source in enumerate(room.sources):
+        for i in range(mics.shape[1]):
+            dist = np.linalg.norm(source.images - mics[:, i, None], axis=0)
+            damp = source.damping[0]
+            idx = np.argsort(dist)
+            jdx = np.argsort(toas[:, i, j])
+            assert np.allclose(toas[jdx, i, j], dist[idx] / c)
+            assert np.allclose(amps[jdx, i, j], damp[idx] / (4 * np.pi * dist[idx]))
+
+    # fixed wall labels: the ceiling image is above the room
+    src_z = srcs[2, None, :]
+    assert np.all(toas[1] * c >= np.abs(mics[2, :, None] - (2 * room_size[2] - src_z)) - 1e-12)
+
+
+def test_image_source_model_high_order():
+    room_size, mics, srcs, absorption = random_setup(3, 2, np.random.default_rng(0))
+    c = constants['speed_of_sound']
+    max_order = 4
+    toas, amps, walls, orders = image_source_model(room_size, mics, srcs, c, max_order, absorption)
+    K = len(orders)
+    assert K == 129
+    assert toas.shape == amps.shape == walls.shape == (K, 3, 2)
+
+    room = make_pra_room(room_size, mics, srcs, absorption, max_order)
+    for j, source in enumerate(room.sources):
+        assert source.images.shape[1] == K
+        for i in range(mics.shape[1]):
+            dist = np.linalg.norm(source.images - mics[:, i, None], axis=0)
+            idx = np.argsort(dist)
+            jdx = np.argsort(toas[:, i, j])
+            assert np.allclose(toas[jdx, i, j], dist[idx] / c)
+            assert np.allclose(amps[jdx, i, j], source.damping[0][idx] / (4 * np.pi * dist[idx]))
+            assert np.all(orders[jdx] == source.orders[idx])
+
+    # one wall per reflection, the first order ones are labelled by their wall
+    assert np.all([len(w) == o for w, o in zip(walls[1:, 0, 0], orders[1:])])
+    assert np.all(walls[:7, 0, 0] == ['d', 'f', 'c', 's', 'n', 'w', 'e'])
+
+
+def test_wall_sequences():
+    # image of the source reflected on the west wall then on the east wall
+    room_size = [4, 5, 3]
+    mic = np.array([[3., 2., 1.]]).T
+    src = np.array([[1., 2., 1.]]).T
+    image = np.array([[2*4 + 1., 2., 1.]]).T[:, :, None]
+    assert get_wall_sequences(room_size, image, mic, 2)[0, 0, 0] == 'we'
+    image = np.array([[1. - 2*4, 2., 1.]]).T[:, :, None]
+    assert get_wall_sequences(room_size, image, mic, 2)[0, 0, 0] == 'ew'
+
+
+def test_synthetic_dataset_numpy_backend():
+    room_size, mics, srcs, absorption = random_setup(5, 1, np.random.default_rng(0))
+    c = constants['speed_of_sound']
+    sdset = SyntheticDataset()
+    sdset.set_room_size(list(room_size))
+    sdset.set_src(*srcs[:, 0])
+    sdset.set_c(c)
+    sdset.set_k_order(3)
+    for wall, a in absorption.items():
+        sdset.set_abs(wall, a)
+
+    tk, ak, wk, orders = sdset.get_notes(mics)
+    assert tk.shape == ak.shape == wk.shape == (63, 5)
+    assert sdset.get_images()[0] is sdset.get_images()[0]
+
+    room = make_pra_room(room_size, mics, srcs, absorption, max_order=3)
+    source = room.sources[0]
+    for i in range(mics.shape[1]):
+        dist = np.linalg.norm(source.images - mics[:, i, None], axis=0)
+        idx = np.argsort(dist)
+        jdx = np.argsort(tk[:, i])
+        assert np.allclose(tk[jdx, i], dist[idx] / c)
+        assert np.allclose(ak[jdx, i], source.damping[0][idx] / dist[idx])
+        assert np.all(orders[jdx] == source.orders[idx])
+
+    sdset.set_mic(*mics[:, 2])
+    sdset.set_k_reflc(10)
+    tk2, ak2, _ = sdset.get_note(tk_order='earliest')
+    assert np.allclose(tk2, np.sort(tk[:, 2])[:10])
+    with pytest.raises(ValueError):
+        sdset.set_backend('matlab')
+
+
+def test_synthetic_dataset_pra_rir():
+    room_size, mics, srcs, absorption = random_setup(1, 1, np.random.default_rng(0))
+    sdset = SyntheticDataset()
+    sdset.set_room_size(list(room_size))
+    sdset.set_mic(*mics[:, 0])
+    sdset.set_src(*srcs[:, 0])
+    sdset.set_c(343.)
+    sdset.set_k_order(3)
+    for wall, a in absorption.items():
+        sdset.set_abs(wall, a)
+    _, rir = sdset.get_rir(normalize=False)
+    tk, ak, wk = sdset.get_note()
+
+    hpf = pra.constants.get('rir_hpf_enable')
+    pra.constants.set('rir_hpf_enable', False)
+    try:
+        room = make_pra_room(room_size, mics, srcs, absorption, max_order=3)
+        room.set_sound_speed(343.)
+        room.compute_rir()
+        # pra delays everything by half of its fractional delay filter
+        ref = room.rir[0][0][40:]
+        sdset.set_backend('pra')
+        _, rir_pra = sdset.get_rir(normalize=False)
+        tk_pra, ak_pra, wk_pra = sdset.get_note()
+    finally:
+        pra.constants.set('rir_hpf_enable', hpf)
+
+    # same amplitude convention (damping / distance) in the notes and in the rirs of both backends
+    L = min(len(rir), len(ref))
+    assert np.allclose(rir[:L], ref[:L], atol=5e-3*np.max(np.abs(ref)))
+    assert np.allclose(rir_pra, ref)
+    idx = np.lexsort((wk, np.round(tk, 9)))
+    jdx = np.lexsort((wk_pra, np.round(tk_pra, 9)))
+    assert np.allclose(tk[idx], tk_pra[jdx])
+    assert np.allclose(ak[idx], ak_pra[jdx])
+    assert np.all(wk[idx] == wk_pra[jdx])
+    assert sdset.get_walls_name_from_id(4) == 'floor'
+
+
+def test_synthesize_rirs():
+    from pyroomacoustics.utilities import fractional_delay
+    room_size, mics, srcs, absorption = random_setup(3, 2, np.random.default_rng(0))
+    c = constants['speed_of_sound']
+    Fs = 16000
+    toas, amps, _, _ = image_source_model(room_size, mics, srcs, c, 2, absorption, walls=False)
+    rirs = synthesize_rirs(toas, amps, Fs, L=2000)
+    assert rirs.shape == (2000, 3, 2)
+
+    # reference: one fractional delay per image as in pra_utils.compute_partial_rir
+    i, j = 1, 0
+    ref = np.zeros(40 + 2000 + 41)
+    for t, a in zip(toas[:, i, j], amps[:, i, j]):
+        n = int(np.round(Fs * t))
+        ref[n:n+81] += a * fractional_delay(Fs * t - n)
+    assert np.allclose(rirs[:, i, j], ref[40:2040], atol=1e-5*np.max(np.abs(ref)))
+
+    # pyroomacoustics' rirs of the same room, amplitudes damping / distance (no 4 pi)
+    hpf = pra.constants.get('rir_hpf_enable')
+    pra.constants.set('rir_hpf_enable', False)
+    try:
+        room = make_pra_room(room_size, mics, srcs, absorption, max_order=2, fs=Fs)
+        room.set_sound_speed(c)
+        room.compute_rir()
+    finally:
+        pra.constants.set('rir_hpf_enable', hpf)
+    for i in range(mics.shape[1]):
+        for j in range(srcs.shape[1]):
+            # pra delays everything by half of its fractional delay filter
+            ref = room.rir[i][j][40:]
+            L = min(len(ref), 2000)
+            assert np.allclose(4 * np.pi * rirs[:L, i, j], ref[:L], atol=5e-3*np.max(np.abs(ref)))
+
+
+def test_images_cache(tmp_path):
+    from dechorate.utils.cache_utils import ArrayCache
+    cache = ArrayCache()
+    notes = []
+    for i in range(3):
+        # a new dataset per microphone as in the recipes
+        sdset = SyntheticDataset(cache=cache, path_to_cache=str(tmp_path))
+        sdset.set_dataset('010101')
+        sdset.set_k_order(2)
+        sdset.set_mic(1 + 0.5*i, 2, 1)
+        notes.append(sdset.get_note()[0])
+    assert (cache.misses, cache.hits) == (1, 2)
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    assert not np.allclose(notes[0], notes[1])
+
+    sdset = SyntheticDataset(cache=None, path_to_cache=str(tmp_path))
+    sdset.set_dataset('010101')
+    sdset.set_k_order(2)
+    sdset.set_mic(2, 2, 1)
+    assert np.allclose(sdset.get_note()[0], notes[2])
+    sdset.set_src(1, 1, 1)
+    images = sdset.get_images()
+    assert len(list(tmp_path.glob('*.npz'))) == 2
+
+
+def test_numeric_planes():
+    from dechorate.utils.geo_utils import compute_planes, compute_image, plane_through_points, dist_points_plane, project_on_plane
+    rng = np.random.default_rng(0)
+    room_size, mics, srcs, absorption = random_setup(4, 6, rng)
+    planes = compute_planes(room_size)
+    for wall in ['c', 'f', 'w', 's', 'e', 'n']:
+        axis, side, _ = WALLS[wall]
+        images = compute_image(srcs, planes[wall])
+        expected = srcs.copy()
+        expected[axis] = 2 * side * room_size[axis] - srcs[axis]
+        assert np.allclose(images, expected)
+        assert np.allclose(dist_points_plane(project_on_plane(mics, planes[wall]), planes[wall]), 0)
+    with pytest.raises(ValueError):
+        plane_through_points(rng.random([3, 5]))
+
+    sdset = SyntheticDataset()
+    sdset.set_k_order(1)
+    images, _, orders = sdset.get_images()
+    assert sdset.get_wall_order_from_images(images, orders, sdset.room_size) == ['d', 'f', 'c', 's', 'n', 'w', 'e']
+    tk, ak, wk = sdset.get_note(tk_order='earliest')
+    tk_all, _, wk_all, _ = sdset.get_notes(np.array(sdset.x))
+    assert np.all(wk == wk_all[np.argsort(tk_all[:, 0]), 0])
+
+
+def test_sample_perturbed_toas():
+    room_size, mics, srcs, _ = random_setup(4, 3, np.random.default_rng(0))
+    c = speed_of_sound_from_temperature(20)
+    toas, toas_nominal, _, walls, orders = sample_perturbed_toas(
+        room_size, mics, srcs, max_order=2, n_draws=10, sigma_mics=0, sigma_srcs=0,
+        temperature=20, sigma_temperature=0)
+    assert toas.shape == (10, 25, 4, 3)
+    assert np.allclose(toas, toas_nominal[None])
+    assert np.allclose(toas_nominal, image_source_model(room_size, mics, srcs, c, 2)[0])
+
+    toas = sample_perturbed_toas(room_size, mics, srcs, n_draws=2000, seed=0)[0]
+    lower, median, upper = echo_confidence_intervals(toas, level=0.9)
+    assert np.all(lower < toas_nominal * c / speed_of_sound_from_temperature(24))
+    assert np.mean((toas > lower) & (toas < upper)) == pytest.approx(0.9, abs=0.01)
+
+    # same draws, statistics accumulated block by block
+    stats = perturbed_toa_intervals(room_size, mics, srcs, n_draws=2000, seed=0, level=0.9)
+    width = upper - lower
+    for a, b in zip(stats[:3], [lower, median, upper]):
+        assert np.all(np.abs(a - b) < 0.03 * width)
+    assert np.allclose(stats[3], np.std(toas, axis=0))
+    assert np.allclose(stats[4], toas_nominal * c / speed_of_sound_from_temperature(24))
+
+
+def test_compute_synthetic_rirs():
+    from dechorate.main_build_synthetic_rirs import compute_synthetic_rirs
+    room_size, mics, srcs, _ = random_setup(4, 1, np.random.default_rng(0))
+    c, Fs, L = 343., 16000, 4000
+    args = ('011010', 3, list(room_size), mics, srcs[:, 0], Fs, L, c, 4, 2, 0.7, 0.1)
+    room_code, src_id, groups = compute_synthetic_rirs(*args)
+    assert (room_code, src_id) == ('011010', 3)
+    rirs = groups['/rir/011010/3']
+    toas = groups['/echo_toa/011010/3']
+    assert rirs.shape == (L, 4)
+    assert toas.shape == groups['/echo_amp/011010/3'].shape == groups['/echo_wall/011010/3'].shape == (25, 4)
+    assert np.all(np.diff(toas, axis=0) >= 0)
+    assert np.all(groups['/echo_wall/011010/3'][0] == b'd')
+
+    # deterministic
+    _, _, again = compute_synthetic_rirs(*args)
+    assert all(np.array_equal(groups[g], again[g]) for g in groups)
+
+    # the same room with the vectorized model (whose amplitudes have the 4 pi)
+    absorption = get_absorption_from_room_code('011010', absb=0.7, refl=0.1)
+    tk, ak, _, _ = image_source_model(room_size, mics, srcs[:, :1], c, 4, absorption, walls=False)
+    assert np.allclose(rirs, synthesize_rirs(tk, 4 * np.pi * ak, Fs, L=L)[:, :, 0])
+    tk, ak, _, _ = image_source_model(room_size, mics, srcs[:, :1], c, 2, absorption, walls=False)
+    idx = np.argsort(tk[:, :, 0], axis=0, kind='stable')
+    assert np.allclose(toas, np.take_along_axis(tk[:, :, 0], idx, axis=0))
+    assert np.allclose(groups['/echo_amp/011010/3'], 4 * np.pi * np.take_along_axis(ak[:, :, 0], idx, axis=0))
+
+
+def test_build_synthetic_rirs_workers(tmp_path, monkeypatch):
+    import sys
+    import h5py
+    import runpy
+    from dechorate.utils.file_utils import get_h5_datasets
+    room_size, mics, srcs, _ = random_setup(4, 9, np.random.default_rng(0))
+    path_to_echo = str(tmp_path / 'annotations.h5')
+    with h5py.File(path_to_echo, 'w') as note:
+        note['room_size'] = room_size
+        note['microphones'] = mics
+        note['sources_directional_position'] = srcs[:, :6]
+        note['sources_omnidirection_position'] = srcs[:, 6:]
+    monkeypatch.setitem(constants, 'datasets', ['000000', '011010'])
+
+    # the pool of workers writes the same file as the serial run
+    for workers in [1, 2]:
+        path_to_output = tmp_path / str(workers)
+        path_to_output.mkdir()
+        monkeypatch.setattr(sys, 'argv', ['main_build_synthetic_rirs.py', '--outdir', str(path_to_output),
+                                          '--echo', path_to_echo, '--order', '3', '--workers', str(workers)])
+        runpy.run_module('dechorate.main_build_synthetic_rirs', run_name='__main__', alter_sys=True)
+    with h5py.File(tmp_path / '1' / 'dEchorate_rir_synth.h5', 'r') as serial, \
+            h5py.File(tmp_path / '2' / 'dEchorate_rir_synth.h5', 'r') as pooled:
+        groups = get_h5_datasets(serial)
+        assert len(groups) == 4 * 2 * 9
+        assert groups == get_h5_datasets(pooled)
+        for group in groups:
+            assert np.array_equal(serial[group][()], pooled[group][()])
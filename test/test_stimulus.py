@@ -0,0 +1,164 @@
+import pytest
+import numpy as np
+import scipy.signal as sg
+
+from dechorate.stimulus import ProbeSignal
+
+
+def make_probe(fs=8000, n_repetitions=3):
+    ps = ProbeSignal('exp_sine_sweep', fs)
+    times, s = ps.generate(10, 0.7, n_repetitions, 2, 2, [100, 3000])
+    return ps, s
+
+
+def make_recording(s, delays, gains):
+    # each channel is the probe through a sparse rir
+    x = np.zeros([len(s), len(delays)])
+    for i, (d, g) in enumerate(zip(delays, gains)):
+        h = np.zeros(d+1)
+        h[d] = g
+        h[d//2] = 0.3*g
+        x[:, i] = sg.fftconvolve(s[:, 0], h)[:len(s)]
+    return x
+
+
+def test_compute_rir():
+    ps, s = make_probe()
+    delays, gains = [40, 100, 333], [1., -0.5, 0.8]
+    x = make_recording(s, delays, gains)
+    rirs = ps.compute_rir(x)
+    assert rirs.shape == (10*ps.fs, 3)
+    # the rirs start one sample before the emission (t in compute_rir)
+    for i, (d, g) in enumerate(zip(delays, gains)):
+        assert np.argmax(np.abs(rirs[:, i])) == d - 1
+        assert np.sign(rirs[d-1, i]) == np.sign(g)
+
+    # same as the former channel by channel complex fft of size 2 Lr
+    Lr = ps.total_duration
+    nfft = 2*Lr
+    t = len(ps.invfilter) + 2*ps.fs
+    X = np.fft.fft(x[:3*Lr, 1].reshape(3, Lr), n=nfft)
+    H = np.mean(np.fft.fft(ps.invfilter, n=nfft) * X, 0)
+    assert np.allclose(rirs[:, 1], np.real(np.fft.ifft(H))[t:t+10*ps.fs])
+    assert len(ps._invfilter_spectra) == 1
+    assert np.allclose(ps.compute_rir(x[:, 2]), rirs[:, 2:])
+
+
+def test_compute_rir_streaming(tmp_path):
+    import h5py
+    import soundfile as sf
+    ps, s = make_probe()
+    x = make_recording(s, [40, 100, 333, 7], [1., -0.5, 0.8, 0.1])
+    rirs = ps.compute_rir(x)
+
+    assert np.allclose(ps.compute_rir_streaming(x, block_size=2**13, channel_block=3), rirs)
+    # cropped window, as in main_estimate_rirs.py
+    assert np.allclose(ps.compute_rir_streaming(x, block_size=2**13, start=333, length=8000), rirs[333:8333])
+
+    path_to_h5 = str(tmp_path / 'chirp.h5')
+    with h5py.File(path_to_h5, 'w') as hdf:
+        hdf.create_dataset('/chirp/000000/0', data=x, chunks=(4096, 1))
+        out = hdf.create_dataset('/rir/000000/0', shape=(4000, 4), dtype='f8')
+        assert ps.compute_rir_streaming(hdf['/chirp/000000/0'], length=4000, out=out) is None
+        assert np.allclose(out[()], rirs[:4000])
+
+    path_to_wav = str(tmp_path / 'chirp.wav')
+    sf.write(path_to_wav, x, ps.fs, subtype='FLOAT')
+    assert np.allclose(ps.compute_rir_streaming(path_to_wav, channel_block=2), rirs, atol=1e-6)
+
+
+def test_probe_cache(tmp_path):
+    from dechorate.utils.cache_utils import ArrayCache
+    cache = ArrayCache()
+    ps1 = ProbeSignal('exp_sine_sweep', 8000, cache=cache, path_to_cache=str(tmp_path))
+    times, s1 = ps1.generate(10, 0.7, 3, 2, 2, [100, 3000])
+    ps2 = ProbeSignal('exp_sine_sweep', 8000, cache=cache)
+    _, s2 = ps2.generate(10, 0.7, 3, 2, 2, [100, 3000])
+    assert ps2.invfilter is ps1.invfilter
+    assert np.allclose(s1, s2) and ps2.freq_ranges == ps1.freq_ranges
+    assert ps2.total_duration == ps1.total_duration
+
+    x = make_recording(s1, [40], [1.])
+    rirs = ps1.compute_rir(x)
+    assert np.allclose(ps2.compute_rir(x), rirs)
+    assert (cache.misses, cache.hits) == (2, 2)
+
+    # served from disk by a fresh cache
+    ps3 = ProbeSignal('exp_sine_sweep', 8000, cache=None, path_to_cache=str(tmp_path))
+    ps3.generate(10, 0.7, 3, 2, 2, [100, 3000])
+    assert np.allclose(ps3.invfilter, ps1.invfilter)
+    assert np.allclose(ps3.compute_rir(x), rirs)
+    assert len(list(tmp_path.glob('*.npz'))) == 2
+    _, s4 = ps3.generate(10, 0.5, 3, 2, 2, [100, 3000])
+    assert np.allclose(s4, s1 * 0.5 / 0.7)
+
+
+def test_fht():
+    from scipy.linalg import hadamard
+    from dechorate.utils.dsp_utils import fht
+    x = np.random.randn(16, 3)
+    assert np.allclose(fht(x), hadamard(16) @ x)
+    with pytest.raises(ValueError):
+        fht(np.zeros(12))
+
+
+@pytest.mark.parametrize('kind', ['hadamard_noise', 'white_noise'])
+def test_noise_probes(kind):
+    ps = ProbeSignal(kind, 8000, seed=0)
+    times, s = ps.generate(2, 0.5, 3, 1, 1, None)
+    assert s.shape == (len(times), 1)
+
+    h = np.zeros([2000, 2])
+    h[[40, 300, 1200], 0] = [1., 0.4, -0.2]
+    h[[7, 555], 1] = [-0.5, 0.1]
+    x = np.stack([sg.fftconvolve(s[:, 0], h[:, i])[:len(s)] for i in range(2)], axis=-1)
+    rirs = ps.compute_rir(x)
+    # as long as the sweep rirs, whatever the probe length
+    assert rirs.shape == (10*ps.fs, 2)
+    assert np.allclose(rirs[:2000], h, atol=1e-9)
+    assert np.allclose(rirs[2000:], 0, atol=1e-9)
+
+
+def test_gcc_phat():
+    from dechorate.utils.dsp_utils import gcc_phat
+    rng = np.random.default_rng(0)
+    N = 4096
+    x = rng.standard_normal(N)
+    # fractional delays applied in the frequency domain
+    delays = np.array([3.25, -10.5, 100.8, 0.])
+    freqs = np.fft.rfftfreq(4*N)
+    X = np.fft.rfft(x, n=4*N)
+    y = np.fft.irfft(X[:, None] * np.exp(-2j*np.pi*freqs[:, None]*delays[None, :]), n=4*N, axis=0)[:N]
+    for phat in [True, False]:
+        est, _ = gcc_phat(x[:, None], y, max_lag=200, phat=phat)
+        assert est.shape == (4,)
+        assert np.allclose(est, delays, atol=0.05)
+        est, _ = gcc_phat(x[:, None], y, max_lag=200, phat=phat, subsample='parabolic')
+        assert np.allclose(est, delays, atol=0.15)
+
+    ps, s = make_probe()
+    rec = make_recording(s, [40, 250], [1., 0.5])
+    assert np.allclose(ps.compute_delay(rec), [40, 250], atol=0.1)
+    assert isinstance(ps.compute_delay(rec[:, 0]), float)
+    assert ps.compute_delay(rec[:, 0]) == pytest.approx(40, abs=0.1)
+
+
+def test_recording_offsets():
+    import h5py
+    from dechorate.main_estimate_recording_offsets import loopback_delays, estimate_offsets
+    ps, s = make_probe(n_repetitions=1)
+    # loopbacks with the typical delay, and two recordings shifted by one and two 4096-sample buffers
+    shifts = {('000000', 0): 0, ('000000', 1): 4096, ('010000', 0): 0, ('010000', 1): 8192, ('011000', 0): 0}
+    base = 37
+    groups = list(shifts.keys())
+    with h5py.File('chirp.h5', 'w', driver='core', backing_store=False) as hdf:
+        for (room_code, src_id), shift in shifts.items():
+            x = np.zeros([len(s) + 10000, 2])
+            x[:, 0] = np.random.default_rng(src_id).standard_normal(len(x))
+            x[base+shift:base+shift+len(s), 1] = 0.5 * s[:, 0]
+            hdf.create_dataset(f'/chirp/{room_code}/{src_id:d}', data=x)
+        delays = loopback_delays(hdf, groups, s, batch=2, max_lag=10000)
+    assert np.allclose(delays, [base + shifts[g] for g in groups], atol=0.1)
+    # the offsets of the table in __init__.py: 4444, 4444 + 4096, 4444 + 2*4096
+    offsets = estimate_offsets(delays, 4444)
+    assert list(offsets) == [4444, 8540, 4444, 12636, 4444]